@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark pygrade on synthetic cohorts of students.
+
+For each cohort size, build that many local student repositories, each pushed
+to its own local bare remote, with submissions of the asg0 example assignment
+(example/test_asg0.py). Then time grading, plagiarism detection, summarizing
+and pushing grades, reporting seconds, students/sec and peak resident memory
+for each stage and size, and how each stage scales with the number of students.
+
+Plagiarism detection is timed three ways: cheat compares every pair of students
+by dense tf-idf similarity, so it is skipped for cohorts over 2000 students (at
+10000 the pairs alone would not fit in memory); cheat-topk keeps each student's
+5 nearest neighbors; and cheat-minhash finds candidate pairs by MinHash.
+
+Cohorts are kept in the working directory and reused by later runs.
+
+usage:
+    bench_pygrade.py [--sizes <list>] [--mix <list>] [--stages <list>] [--jobs <n>] [--workdir <dir>] [--output <file>]
+
+Options
+    -h, --help
+    -j, --jobs <n>              Number of students to grade in parallel [default: 1]
+    -m, --mix <list>            Relative numbers of correct, failing, erroring, slow and non-importing
+                                submissions [default: 4,2,2,1,1]
+    -o, --output <file>         Also append each measurement to this file as a line of JSON.
+    -s, --sizes <list>          Comma-separated cohort sizes [default: 10,100,1000,10000]
+    -t, --stages <list>         Comma-separated stages to time
+                                [default: grade,summarize,cheat,cheat-topk,cheat-minhash,push]
+    -w, --workdir <dir>         Directory in which to build the cohorts [default: bench]
+"""
+from collections import defaultdict
+from docopt import docopt
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+from pygrade import read_students
+from pygrade import cheat, grade, push, summarize
+
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'test_asg0.py')
+
+SUBMISSIONS = {
+    'correct': "def is_mammal(x):\n    return x in ['cat', 'dog', 'dolphin']\n\n\n"
+               "def add(a, b):\n    return a + b\n",
+    'failing': "def is_mammal(x):\n    return x == 'cat'\n\n\n"
+               "def add(a, b):\n    return a - b\n",
+    'erroring': "def is_mammal(x):\n    return x.species == 'mammal'\n\n\n"
+                "def add(a, b):\n    return a + b + None\n",
+    'slow': "def is_mammal(x):\n    total = 0\n    for i in range(200000):\n        total += i\n"
+            "    return x in ['cat', 'dog', 'dolphin']\n\n\n"
+            "def add(a, b):\n    return sum([a, b])\n",
+    'broken': "def is_mammal(x)\n    return True\n",
+}
+KINDS = ['correct', 'failing', 'erroring', 'slow', 'broken']
+
+
+def git(*args):
+    subprocess.check_call(['git'] + list(args), stdout=subprocess.DEVNULL)
+
+
+def make_student(path, remote_path, src):
+    """ Make a local repository with this submission, pushed to a new bare remote. """
+    os.makedirs(os.path.join(path, 'asg0'))
+    with open(os.path.join(path, 'asg0', 'asg0.py'), 'w') as f:
+        f.write(src)
+    git('init', '-q', '--bare', remote_path)
+    git('init', '-q', path)
+    git('-C', path, 'add', 'asg0/asg0.py')
+    git('-C', path, '-c', 'user.name=bench', '-c', 'user.email=bench@example.com', 'commit', '-q', '-m', 'asg0')
+    git('-C', path, 'remote', 'add', 'origin', remote_path)
+    git('-C', path, 'push', '-q', '-u', 'origin', 'HEAD')
+
+
+def make_cohort(n, mix, path):
+    """
+    Build a cohort of n students under path, unless it already exists, and return
+    the paths of its students file and test file. Submissions cycle through the
+    kinds in KINDS, each repeated as many times as its weight in mix.
+    """
+    students_path = os.path.join(path, 'students.tsv')
+    test_path = os.path.join(path, 'test_asg0.py')
+    if os.path.exists(students_path):
+        return students_path, test_path
+    print('building cohort of %d students in %s' % (n, path))
+    pattern = [kind for kind, weight in zip(KINDS, mix) for _ in range(weight)]
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.join(path, 'remotes'))
+    shutil.copy(TEST_FILE, test_path)
+    rows = ['github_repo\tgithub_id']
+    for i in range(n):
+        remote_path = os.path.abspath(os.path.join(path, 'remotes', 'student%d' % i))
+        make_student(os.path.join(path, 'students', 'student%d' % i), remote_path + '.git',
+                     SUBMISSIONS[pattern[i % len(pattern)]])
+        rows.append('%s\tstudent%d' % (remote_path, i))
+    with open(students_path + '.tmp', 'w') as f:
+        f.write('\n'.join(rows) + '\n')
+    # Written last, so an interrupted build is not mistaken for a finished one.
+    os.rename(students_path + '.tmp', students_path)
+    return students_path, test_path
+
+
+def run_grade(students, test_path, path, jobs):
+    results = grade.run_tests(students, test_path, os.path.join(path, 'students'), False,
+                              defaultdict(lambda: []), jobs=jobs)
+    grade.write_grades(results, os.path.join(path, 'grades.json'))
+
+
+def read_grades(path):
+    return [json.loads(line) for line in open(os.path.join(path, 'grades.json'))]
+
+
+def run_summarize(students, test_path, path, jobs):
+    student_names = [s['github_id'] for s in students[:10]]
+    reports = summarize.StreamReports(['test_add', 'test_hard'], student_names)
+    summarize.print_reports(reports.add_file(os.path.join(path, 'grades.json')), ['test_add', 'test_hard'],
+                            student_names, True)
+
+
+def run_cheat(students, test_path, path, jobs, **kwargs):
+    results = cheat.compare_assignments(students, test_path, os.path.join(path, 'students'), **kwargs)
+    cheat.write_output(results, os.path.join(path, 'cheats.tsv'))
+
+
+def run_cheat_topk(students, test_path, path, jobs):
+    run_cheat(students, test_path, path, jobs, top_k=5)
+
+
+def run_cheat_minhash(students, test_path, path, jobs):
+    run_cheat(students, test_path, path, jobs, method='minhash')
+
+
+def run_push(students, test_path, path, jobs):
+    push.push_grades(read_grades(path), os.path.join(path, 'students'))
+
+
+STAGES = {'grade': run_grade, 'summarize': run_summarize, 'cheat': run_cheat, 'cheat-topk': run_cheat_topk,
+          'cheat-minhash': run_cheat_minhash, 'push': run_push}
+
+# The largest cohort to run each stage on, for stages whose memory grows with the square of it.
+MAX_STUDENTS = {'cheat': 2000}
+
+
+def _measure_worker(conn, func, args):
+    # Silence the stage's own progress output, including that of its subprocesses.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    # Grading in this process resets its peak memory before each test, so ask grade for it.
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    conn.send((seconds, max(grade.max_rss(), rss // 1024 if sys.platform == 'darwin' else rss)))
+    conn.close()
+
+
+def measure(func, *args):
+    """ Run func(*args) in a new process and return the seconds it took and the peak
+    resident memory, in kilobytes, of that process or any of its children. """
+    ctx = multiprocessing.get_context('fork')
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_measure_worker, args=(send_conn, func, args))
+    proc.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    return result
+
+
+def print_scaling(measurements):
+    """ Print, for each stage, the exponent k such that its time grows as n^k
+    between consecutive cohort sizes n. """
+    print('\n\n----------------------------\nscaling (time ~ n^k):\n%13s\t%8s\t%8s\tk' % ('stage', 'from', 'to'))
+    stage2points = defaultdict(lambda: [])
+    for m in measurements:
+        stage2points[m['stage']].append((m['students'], m['seconds']))
+    for stage, points in stage2points.items():
+        for (n1, t1), (n2, t2) in zip(points, points[1:]):
+            print('%13s\t%8d\t%8d\t%.2f' % (stage, n1, n2, math.log(t2 / t1) / math.log(float(n2) / n1)))
+
+
+def main():
+    args = docopt(__doc__)
+    sizes = [int(n) for n in args['--sizes'].split(',')]
+    mix = [int(w) for w in args['--mix'].split(',')]
+    stages = args['--stages'].split(',')
+    jobs = int(args['--jobs'])
+    measurements = []
+    print('%13s\t%8s\t%8s\t%10s\t%10s' % ('stage', 'students', 'seconds', 'students/s', 'peak MB'))
+    for n in sizes:
+        path = os.path.join(args['--workdir'], '%d-%s' % (n, '-'.join(map(str, mix))))
+        students_path, test_path = make_cohort(n, mix, path)
+        students = read_students(students_path)
+        for stage in stages:
+            if n > MAX_STUDENTS.get(stage, n):
+                print('%13s\t%8d\tskipped' % (stage, n))
+                continue
+            result = measure(STAGES[stage], students, test_path, path, jobs)
+            if result is None:
+                print('%13s\t%8d\tfailed' % (stage, n))
+                continue
+            seconds, rss = result
+            m = {'stage': stage, 'students': n, 'jobs': jobs, 'seconds': seconds,
+                 'students_per_second': n / seconds, 'peak_rss_kb': rss}
+            measurements.append(m)
+            print('%13s\t%8d\t%8.2f\t%10.1f\t%10.1f' % (stage, n, seconds, n / seconds, rss / 1024.))
+            sys.stdout.flush()
+            if args['--output']:
+                with open(args['--output'], 'a') as f:
+                    f.write(json.dumps(m) + '\n')
+    print_scaling(measurements)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,25 @@ __author__ = 'Aron Culotta'
 __email__ = 'aronwc@gmail.com'
 __version__ = '0.2.5'
 
+import ast
 import csv
 import errno
 import git
+import hashlib
+import json
 import os
+import random
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Resource limits that may be set in the test file, e.g. @student_timeout=60
+#   test_timeout: default wall-clock seconds for each test (a test's own @timeout overrides it)
+#   student_timeout: wall-clock seconds for grading one student
+#   memory_limit: address space, in megabytes, of the process grading one student
+#   cpu_limit: CPU seconds for the process grading one student
+LIMITS = ['test_timeout', 'student_timeout', 'memory_limit', 'cpu_limit']
 
 
 def extract_metadata(text, result):
@@ -20,28 +33,68 @@ def extract_metadata(text, result):
     ['a0/foo.py', 'a0/bar.py']
     >>> extract_metadata('@possible_points=12.4', {})['possible_points']
     12.4
+    >>> extract_metadata('@memory_limit=512', {})['memory_limit']
+    512.0
     """
     match = re.search(r'\@name\s*=\s*(.+)', text)
     if match:
         filenames = match.group(1)
         result['files_to_test'] = re.split('\s*,\s*', filenames)
-    match = re.search(r'\@possible_points\s*=\s*([0-9\.]+)', text)
-    if match:
-        result['possible_points'] = float(match.group(1))
+    for key in ['possible_points'] + LIMITS:
+        match = re.search(r'\@%s\s*=\s*([0-9\.]+)' % key, text)
+        if match:
+            result[key] = float(match.group(1))
     return result
 
 
+def index_tests(source, filename='<test>'):
+    """
+    Parse the source of a unit test file and index its test methods by
+    'Class.method'. Each entry has the @points and @timeout from the method's
+    docstring (None if absent), the docstring itself, and the method's source.
+    >>> tests = index_tests("class T:\\n    def test_a(self):\\n        ''' @points=3 '''\\n        pass\\n")
+    >>> tests['T.test_a']['points'], tests['T.test_a']['doc']
+    (3.0, ' @points=3 ')
+    """
+    lines = source.splitlines(True)
+    tests = {}
+    for cls in ast.parse(source, filename).body:
+        if not isinstance(cls, ast.ClassDef):
+            continue
+        for node in cls.body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) or not node.name.startswith('test'):
+                continue
+            doc = ast.get_docstring(node, clean=False)
+            points = re.search(r'\@points\s*=\s*([0-9\.]+)', doc or '')
+            timeout = re.search(r'\@timeout\s*=\s*([0-9\.]+)', doc or '')
+            start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            tests['%s.%s' % (cls.name, node.name)] = {
+                'points': float(points.group(1)) if points else None,
+                'timeout': float(timeout.group(1)) if timeout else None,
+                'doc': doc,
+                'source': ' '.join(lines[start - 1:node.end_lineno])}
+    return tests
+
+
 def read_assignment_metadata(test_file):
     """
     Extracts metadata in the comments of the unit test file. E.g.:
     @name=a0/boolean_search.py,a0/run.py
     @possible_points=50
+    @test_timeout=10
+    Also indexes the test methods in the file; see index_tests.
     """
     result = {'files_to_test': None,
               'possible_points': None}
+    result.update((key, None) for key in LIMITS)
 
-    for line in open(test_file):
+    source = open(test_file).read()
+    for line in source.splitlines():
         extract_metadata(line, result)
+    try:
+        result['tests'] = index_tests(source, test_file)
+    except SyntaxError:  # Reported when the tests are run.
+        result['tests'] = {}
     return result
 
 
@@ -75,31 +128,275 @@ def get_local_repo(s, path):
     return os.path.join(path, os.path.basename(s['github_repo']))
 
 
-def clone_repo(student, path):
+def hash_file(path):
+    """ Return the SHA-1 hex digest of this file's contents, or None if it cannot be read. """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def get_head_sha(local_repo):
+    """ Return the SHA of the commit checked out in this repository, or None if
+    it is not a git repository or has no commits. """
+    try:
+        return git.Repo(local_repo).head.commit.hexsha
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, ValueError):
+        return None
+
+
+def resolve_commit(local_repo, ref='HEAD', before=None):
+    """ Return the SHA of the commit that ref names in this repository, or, if
+    before is given, of the last commit reachable from ref that was committed
+    before that time (in any format git log --before accepts). Return None if
+    there is no such commit. """
     try:
-        repo = student['github_repo']
-        topath = get_local_repo(student, path)
-        print('  cloning %s to %s ...' % (repo, topath))
-        git.repo.base.Repo.clone_from(repo + '.git', topath)
+        repo = git.Repo(local_repo)
+        if before:
+            return repo.git.rev_list('-1', '--before=%s' % before, ref) or None
+        return repo.commit(ref).hexsha
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, git.exc.GitCommandError,
+            git.exc.BadName, ValueError):
+        return None
+
+
+def read_blobs(local_repo, commit, subpaths):
+    """ Return a dictionary from each of these paths to the contents of that file
+    in the given commit, as bytes, or None if the file is not in the commit. """
+    tree = git.Repo(local_repo).commit(commit).tree
+    blobs = {}
+    for subpath in subpaths:
+        try:
+            blobs[subpath] = tree[subpath].data_stream.read()
+        except KeyError:
+            blobs[subpath] = None
+    return blobs
+
+
+# Bare clone, in the working directory, of the template repository that student repositories start from.
+REFERENCE_REPO = '.template.git'
+
+# File, in the working directory, of the remote SHA that each student's repository was last pulled, and
+# last fetched, at.
+LAST_PULLED = '.last_pulled.json'
+
+# Messages of git errors that are worth retrying, as they may not happen again.
+TRANSIENT_GIT_ERRORS = re.compile(r'could not resolve host|timed out|connection (reset|refused|closed)|early eof|'
+                                  r'rpc failed|remote end hung up|HTTP (429|5\d\d)|temporar', re.I)
+
+
+def is_transient_error(message):
+    """ Is this git error worth retrying?
+    >>> is_transient_error("fatal: unable to access 'x': Could not resolve host: github.com")
+    True
+    >>> is_transient_error("fatal: repository 'x' not found")
+    False
+    """
+    return TRANSIENT_GIT_ERRORS.search(message) is not None
+
+
+def sparse_dirs(files):
+    """ Return the directories to check out in a sparse clone that has these files
+    (e.g. the @name paths of a test file). Files at the top of the repository are
+    always checked out.
+    >>> sparse_dirs(['a0/foo.py', 'a0/bar.py', 'run.py'])
+    ['a0']
+    """
+    return sorted(set(os.path.dirname(f) for f in files) - set(['']))
+
+
+def widen_sparse_checkout(local_repo, dirs):
+    """ If this is a sparse clone, add to its checkout any of these directories it
+    lacks, fetching their files. Return False if that failed. """
+    if not os.path.exists(os.path.join(local_repo, '.git', 'info', 'sparse-checkout')):
+        return True
+    try:
+        repo = git.Repo(local_repo)
+        missing = set(dirs) - set(repo.git.sparse_checkout('list').splitlines())
+        if missing:
+            print('  adding %s to sparse checkout of %s' % (', '.join(sorted(missing)), local_repo))
+            repo.git.sparse_checkout('add', *sorted(missing))
         return True
     except git.exc.GitCommandError as e:
         print(e)
         return False
 
 
+def update_reference_repo(remote_repo, path):
+    """ Clone the template repository at remote_repo into REFERENCE_REPO under path,
+    or fetch it if already cloned, and return the local path. Student repositories
+    cloned with it as a reference (see add_alternate) borrow its objects rather
+    than storing and downloading their own copies. It is never garbage collected,
+    as they would break if objects they borrow were removed. Return None if it
+    cannot be cloned or fetched. """
+    ref_path = os.path.abspath(os.path.join(path, REFERENCE_REPO))
+    try:
+        if os.path.isdir(ref_path):
+            repo = git.Repo(ref_path)
+        else:
+            print('  cloning template %s to %s ...' % (remote_repo, ref_path))
+            repo = git.Repo.clone_from(remote_repo, ref_path, bare=True)
+            repo.git.config('gc.auto', '0')
+        repo.git.fetch('origin', '+refs/heads/*:refs/heads/*', '--tags')
+        return ref_path
+    except git.exc.GitCommandError as e:
+        print(e)
+        return None
+
+
+def add_alternate(local_repo, reference):
+    """ Let this repository use the objects of the reference repository, so those
+    are not fetched or stored again. """
+    alternates = os.path.join(local_repo, '.git', 'objects', 'info', 'alternates')
+    if not os.path.isdir(os.path.dirname(alternates)):  # Not a git repository.
+        return
+    objects = os.path.join(os.path.abspath(reference), 'objects')
+    existing = open(alternates).read().splitlines() if os.path.exists(alternates) else []
+    if objects not in existing:
+        with open(alternates, 'a') as f:
+            f.write(objects + '\n')
+
+
+def _clone_with_retries(student, path, retries=0, backoff=1., sparse=None, reference=None):
+    """ Clone this student's repository, retrying transient failures after waiting
+    backoff seconds, then about twice that, and so on. If sparse is a list of
+    directories, make a partial clone, which downloads files only when they are
+    checked out, and check out just those directories (see sparse_dirs).
+    If reference is the path of a local repository (see update_reference_repo),
+    objects in it are borrowed rather than downloaded.
+    Return the number of attempts and the error message of the last one, or None
+    if it succeeded. """
+    repo = student['github_repo']
+    topath = get_local_repo(student, path)
+    options = ['--filter=blob:none', '--sparse'] if sparse is not None else []
+    if reference:
+        options += ['--reference-if-able', reference]
+    for attempt in range(retries + 1):
+        try:
+            print('  cloning %s to %s ...' % (repo, topath))
+            local = git.repo.base.Repo.clone_from(repo + '.git', topath, multi_options=options)
+            if sparse:
+                local.git.sparse_checkout('set', *sparse)
+            return attempt + 1, None
+        except git.exc.GitCommandError as e:
+            print(e)
+            error = str(e)
+        if attempt == retries or not is_transient_error(error):
+            break
+        # Jitter keeps concurrent clones from retrying in lockstep.
+        time.sleep(backoff * 2 ** attempt * random.uniform(1, 2))
+    return attempt + 1, error
+
+
+def clone_repo(student, path, retries=0, backoff=1., sparse=None, reference=None):
+    """ Clone this student's repository; see _clone_with_retries. Return True if it succeeded. """
+    attempts, error = _clone_with_retries(student, path, retries, backoff, sparse, reference)
+    return error is None
+
+
 def pull_repo(local_repo):
     try:
         repo = git.Repo(local_repo)
         repo.remotes[0].pull()
+        return True
     except git.exc.GitCommandError as e:
         print(e)
         return False
 
 
-def clone_repos(students, path):
-    """ Clone all student repos. """
-    for s in students:
-        clone_repo(s, path)
+def fetch_repo(local_repo):
+    """ Fetch from the student's remote without touching the working tree. """
+    try:
+        repo = git.Repo(local_repo)
+        repo.remotes[0].fetch()
+        return True
+    except git.exc.GitCommandError as e:
+        print(e)
+        return False
+
+
+def remote_head(local_repo):
+    """ Return the SHA that the branch this repository pulls from points to on its
+    remote, found with git ls-remote, or None if it cannot be found. """
+    try:
+        repo = git.Repo(local_repo)
+        remote = repo.remotes[0]
+        tracking = repo.active_branch.tracking_branch()
+        ref = 'refs/heads/' + tracking.remote_head if tracking else 'HEAD'
+        out = repo.git.ls_remote(remote.name, ref)
+        return out.split()[0] if out else None
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, git.exc.GitCommandError,
+            IndexError, TypeError, ValueError):  # TypeError: detached HEAD.
+        return None
+
+
+def read_last_pulled(path):
+    """ Return a dictionary with, under 'pull' and 'fetch', a dictionary from
+    github_id to the remote SHA each student's repository under path was last
+    pulled or fetched at (see find_changed_repos). A pull is also a fetch, but a
+    fetch leaves the working tree behind, so it must be pulled again. """
+    last_pulled = {'pull': {}, 'fetch': {}}
+    try:
+        with open(os.path.join(path, LAST_PULLED)) as f:
+            last_pulled.update(json.load(f))
+    except (IOError, OSError, ValueError):
+        pass
+    return last_pulled
+
+
+def write_last_pulled(path, last_pulled):
+    tmp_path = os.path.join(path, LAST_PULLED + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(last_pulled, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, os.path.join(path, LAST_PULLED))
+
+
+def find_changed_repos(students, path, last_seen, jobs=16):
+    """ Check the remote of each student's repository, jobs at a time, and return
+    a dictionary from the github_id of each student whose remote has moved since
+    the SHA in last_seen (see read_last_pulled) to its new SHA. A student whose remote cannot be checked
+    is included with the SHA None, so they are pulled anyway. """
+    def check(s):
+        return s['github_id'], remote_head(get_local_repo(s, path))
+
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        heads = list(pool.map(check, students))
+    return dict((github_id, sha) for github_id, sha in heads if sha is None or last_seen.get(github_id) != sha)
+
+
+def clone_repos(students, path, jobs=1, retries=0, backoff=1., sparse=None, reference=None):
+    """
+    Clone all student repos, up to jobs at a time, retrying transient failures
+    (see _clone_with_retries). Repositories that already have a local copy are
+    skipped, so this can be rerun to clone the ones that failed. If sparse is a
+    list of directories, repositories are cloned sparsely, and those already
+    cloned sparsely have any of the directories they lack added. If reference is
+    given, all repos borrow its objects (see update_reference_repo).
+    Return a report of the github_repo of each student that was cloned or skipped,
+    and of each that failed, with its attempts and error.
+    """
+    def clone(s):
+        topath = get_local_repo(s, path)
+        if os.path.isdir(os.path.join(topath, '.git')):
+            if sparse and not widen_sparse_checkout(topath, sparse):
+                return s, 'failed', 0, 'could not add %s to sparse checkout' % ', '.join(sparse)
+            if reference:
+                add_alternate(topath, reference)
+            return s, 'skipped', 0, None
+        if os.path.exists(topath) and os.listdir(topath):
+            return s, 'failed', 0, '%s exists and is not a git repository' % topath
+        attempts, error = _clone_with_retries(s, path, retries, backoff, sparse, reference)
+        return s, 'failed' if error else 'cloned', attempts, error
+
+    report = {'cloned': [], 'skipped': [], 'failed': []}
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        for s, status, attempts, error in pool.map(clone, students):
+            if status == 'failed':
+                report['failed'].append({'github_repo': s['github_repo'], 'attempts': attempts, 'error': error})
+            else:
+                report[status].append(s['github_repo'])
+    return report
 
 
 def mktmpdir(subdir):
@@ -3,63 +3,570 @@
 """Check for cheating. Output file in format:
 distance  file1  file2
 
+With --method tfidf, distance is the cosine distance between the TF-IDF vectors
+of two submissions. Every pair is listed, unless --top-k or --threshold is
+given, in which case only each submission's nearest neighbours, or pairs at
+least that similar (1 - distance), are listed; distances are then computed a
+block of submissions at a time, so memory stays bounded.
+With --method minhash, distance is 1 minus the estimated Jaccard similarity of
+their sets of token shingles, and only pairs at least --threshold similar are
+listed; it scales to thousands of submissions, as it never compares every pair.
+With --method winnow, Python tokens are normalized, so renaming variables or
+changing literals and comments does not hide a copy, and submissions are
+compared by their winnowed fingerprints (as in MOSS). distance is 1 minus the
+fraction of the smaller submission's fingerprints that the other shares, and
+only pairs at least --threshold similar are listed, with a fourth column of the
+line ranges that match, e.g. asg0/asg0.py:3-10=asg0/asg0.py:5-12, separated by
+spaces.
+
 usage:
-    pygrade cheat --test <file> [--students <file>] [--output <file>] [--workdir <file>]
+    pygrade cheat --test <file> [--students <file>] [--output <file>] [--workdir <file>] [--method <name>]
+                  [--threshold <x>] [--top-k <k>] [--jobs <n>] [--archive <file>] [--cache <dir>]
 
 Options
     -h, --help
+    -a, --archive <file>            With --method winnow, a SQLite file in which to keep fingerprints across runs,
+                                    and semesters, so that only new or changed submissions are fingerprinted, and
+                                    they are compared with every archived submission of the assignment.
+    -c, --cache <dir>               With --method tfidf or minhash, a directory in which to cache each file's source
+                                    without comments, by the hash of its contents, so unchanged files are not
+                                    parsed again.
+    -j, --jobs <n>                  Number of processes reading files and computing tfidf distances [default: 1]
+    -k, --top-k <k>                 With --method tfidf, list only each submission's k nearest neighbours.
+    -m, --method <name>             tfidf, minhash or winnow [default: tfidf]
     -o, --output <file>             Output file [default: cheats.tsv]
     -s, --students <file>           Students TSV file [default: students.tsv]
     -t, --test <file>               File containing python tests for grading
+    --threshold <x>                 The least similarity (0 to 1) of pairs to list; 0.5 if not given with minhash
+                                    or winnow.
     -w, --workdir <file>            Temporary directory for storing assignments [default: students]
 """
+from collections import defaultdict
 from docopt import docopt
+import hashlib
+import io
 from itertools import combinations
+import keyword
+import multiprocessing
+import numpy as np
 import os
 import re
+import sqlite3
+import sys
+import tokenize
+import zlib
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import pairwise_distances
+from sklearn.metrics import pairwise_distances, pairwise_distances_chunked
 
 from . import get_local_repo, read_assignment_metadata, read_students
 
 
+COMMENT_RE = re.compile(r'"""(?s:.+?)"""|\'\'\'(?s:.+?)\'\'\'|#.+')
+BLANK_LINES_RE = re.compile(r'\n[\n\s]+')
+
+
 def strip_comments(src):
-    src = re.sub(re.compile('\"\"\".+?\"\"\"', re.DOTALL), ' ', src)
-    src = re.sub(re.compile(r"\'\'\'.+?\'\'\'", re.DOTALL), ' ', src)
-    src = re.sub(r'#.+', ' ', src)
-    src = re.sub(re.compile(r'\n[\n\s]+', re.MULTILINE), '\n', src)
-    return src
+    """ Remove triple-quoted strings, comments and blank lines.
+    >>> strip_comments("''' Doc. '''\\nx = 1  # one\\n\\n\\ny = 2\\n")
+    ' \\nx = 1   \\ny = 2\\n'
+    """
+    src = COMMENT_RE.sub(' ', src)
+    return BLANK_LINES_RE.sub('\n', src)
 
 
-def parse_assignments(students, test_path, path):
+def read_sources(students, test_path, path):
+    """ Return, for each student, a dictionary from the subpath of each of their
+    assignment files to its source, and the path of each student's repository. """
     metadata = read_assignment_metadata(test_path)
     assignment_subpaths = metadata['files_to_test']
-    strings = []
+    sources = []
     filenames = []
     for s in students:
-        this_string = ''
         repo = get_local_repo(s, path)
+        files = {}
         for assignment_subpath in assignment_subpaths:
-
             fname = os.path.join(repo, assignment_subpath)
             try:
-                src = '\n'.join(open(fname).readlines())
-                #strings.append(strip_comments(src))
-                #filenames.append(fname)
-                this_string += strip_comments(src)
+                files[assignment_subpath] = open(fname).read()
             except FileNotFoundError as e:
                 print('FileNotFound' + str(e))
-                pass
-        strings.append(this_string)
+        sources.append(files)
         filenames.append(repo)
+    print('read %d files' % len(sources))
+    return sources, filenames
+
+
+def normalize_file(fname, cache_dir=None):
+    """ Return the source of this file without comments (see strip_comments), or
+    None if it does not exist. If cache_dir is given, the result is saved there
+    under the SHA-1 of the file's contents, and read from there if already saved. """
+    try:
+        with open(fname, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError as e:
+        print('FileNotFound' + str(e))
+        return None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, hashlib.sha1(data).hexdigest())
+        if os.path.exists(cache_path):
+            with open(cache_path, encoding='utf-8') as f:
+                return f.read()
+    src = strip_comments(data.decode('utf-8', 'replace').replace('\r\n', '\n'))
+    if cache_dir:
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(src)
+        os.replace(tmp_path, cache_path)
+    return src
+
+
+def _normalize_files(args):
+    fnames, cache_dir = args
+    return ''.join(src for src in (normalize_file(fname, cache_dir) for fname in fnames) if src is not None)
+
+
+def iter_assignments(students, test_path, path, jobs=1, cache_dir=None):
+    """ Yield the source of each student's assignment files, without comments, in
+    the order of students, reading and normalizing them in jobs processes. If
+    cache_dir is given, normalized files are cached there (see normalize_file). """
+    assignment_subpaths = read_assignment_metadata(test_path)['files_to_test']
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tasks = (([os.path.join(get_local_repo(s, path), subpath) for subpath in assignment_subpaths], cache_dir)
+             for s in students)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for src in pool.imap(_normalize_files, tasks, chunksize=16):
+                yield src
+        finally:
+            pool.terminate()
+    else:
+        for src in map(_normalize_files, tasks):
+            yield src
+
+
+def read_assignments(students, test_path, path, jobs=1, cache_dir=None):
+    """ Return the source of each student's assignment files, without comments,
+    and the path of each student's repository. See iter_assignments. """
+    strings = list(iter_assignments(students, test_path, path, jobs, cache_dir))
     print('read %d files' % len(strings))
+    return strings, [get_local_repo(s, path) for s in students]
+
+
+def parse_assignments(students, test_path, path, jobs=1, cache_dir=None):
+    """ Return the TF-IDF vectors of each student's assignment files, which are
+    streamed to the vectorizer as they are read, and the path of each student's
+    repository. See iter_assignments. """
     vec = TfidfVectorizer(token_pattern=r'(?u)\b\w+\b')
-    X = vec.fit_transform(strings)
-    return X, filenames
+    X = vec.fit_transform(iter_assignments(students, test_path, path, jobs, cache_dir))
+    print('read %d files' % X.shape[0])
+    return X, [get_local_repo(s, path) for s in students]
+
+
+# Modulus of the MinHash hash functions; a prime, small enough that products of hashes fit in 64 bits.
+MINHASH_PRIME = (1 << 31) - 1
+SHINGLE_BASE = 1000003
+
+
+def shingles(src, size=5):
+    """ Return an array of the distinct hashes of each run of size consecutive
+    tokens in src (or of all its tokens, if there are fewer).
+    >>> len(shingles('a = b + c'))
+    1
+    >>> list(shingles('a = b + c')) == list(shingles('a  =  b+c'))
+    True
+    """
+    tokens = np.array([zlib.crc32(t.encode('utf-8')) for t in re.findall(r'(?u)\b\w+\b|[^\w\s]', src)],
+                      dtype=np.uint64) % MINHASH_PRIME
+    if len(tokens) == 0:
+        return tokens
+    n = max(1, len(tokens) - size + 1)
+    hashes = np.zeros(n, dtype=np.uint64)
+    for k in range(min(size, len(tokens))):  # Horner's rule, modulo the prime, over each window.
+        hashes = (hashes * SHINGLE_BASE + tokens[k:k + n]) % MINHASH_PRIME
+    return np.unique(hashes)
+
+
+def minhash_signatures(strings, num_perm=128, seed=0):
+    """ Return an array with a row for each string, of the least value of each of
+    num_perm random hash functions over the string's shingles. The fraction of
+    entries two rows share estimates the Jaccard similarity of their shingles.
+    Strings without any shingles get a row of -1. """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, num_perm).astype(np.uint64)
+    b = rng.randint(0, MINHASH_PRIME, num_perm).astype(np.uint64)
+    signatures = np.full((len(strings), num_perm), -1, dtype=np.int64)
+    for i, src in enumerate(strings):
+        hashes = shingles(src)
+        if len(hashes):
+            signatures[i] = ((np.outer(hashes, a) + b) % MINHASH_PRIME).min(axis=0)
+    return signatures
+
+
+def lsh_bands(threshold, num_perm=128):
+    """ Return the number of bands to split MinHash signatures into (see
+    lsh_candidates). Pairs become more likely than not to share a band at a
+    similarity of about (1 / bands) ** (bands / num_perm); bands are chosen to put
+    that as close to threshold as possible without exceeding it, so that few pairs
+    above the threshold are missed. Bands must evenly divide the signature.
+    >>> lsh_bands(0.5), lsh_bands(0.8)
+    (32, 16)
+    """
+    def turning_point(bands):
+        return (1. / bands) ** (float(bands) / num_perm)
+    divisors = [bands for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return max([bands for bands in divisors if turning_point(bands) <= threshold] or [num_perm],
+               key=turning_point)
+
+
+def lsh_candidates(signatures, bands):
+    """ Return the set of pairs (i, j), i < j, of rows of signatures that are
+    identical in at least one of bands equal slices. """
+    rows = signatures.shape[1] // bands
+    candidates = set()
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for i, key in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            if key[0] >= 0:
+                buckets[key.tobytes()].append(i)
+        for bucket in buckets.values():
+            candidates.update(combinations(bucket, 2))
+    return candidates
+
+
+def compare_minhash(strings, filenames, threshold=0.5, num_perm=128):
+    """ Return the (distance, file1, file2) tuples, sorted by distance, of pairs
+    of strings with estimated Jaccard similarity of at least threshold (see
+    minhash_signatures). Only pairs that LSH finds as candidates are scored. """
+    signatures = minhash_signatures(strings, num_perm)
+    candidates = lsh_candidates(signatures, lsh_bands(threshold, num_perm))
+    print('scoring %d candidate pairs' % len(candidates))
+    distance_tuples = []
+    for i, j in candidates:
+        similarity = np.mean(signatures[i] == signatures[j])
+        if similarity >= threshold:
+            distance_tuples.append((1 - similarity, filenames[i], filenames[j]))
+    return sorted(distance_tuples)
+
+
+def nearest_pairs(vectors, filenames, top_k=None, threshold=None, jobs=1, working_memory=64):
+    """
+    Return the (distance, file1, file2) tuples, sorted by cosine distance, of each
+    row of vectors and its top_k nearest other rows, or the other rows at least
+    threshold similar (1 - distance), or both. Distances are computed by jobs
+    processes, in blocks of rows taking about working_memory megabytes.
+    >>> import numpy as np
+    >>> nearest_pairs(np.array([[1, 0], [1, 0.1], [0, 1]]), ['a', 'b', 'c'], top_k=1)[0][1:]
+    ('a', 'b')
+    >>> nearest_pairs(np.array([[1., 0]]), ['a'], top_k=3)
+    []
+    """
+    if vectors.shape[0] < 2:
+        return []
+    k = min(top_k, vectors.shape[0] - 1) if top_k else None
+    max_distance = 1 - threshold if threshold is not None else np.inf
+
+    def reduce_block(distances, start):
+        rows = np.arange(len(distances))
+        distances[rows, start + rows] = np.inf  # Not its own neighbour.
+        if k:
+            cols = np.argpartition(distances, k - 1, axis=1)[:, :k].ravel()
+            rows = np.repeat(rows, k)
+            keep = np.isfinite(distances[rows, cols]) & (distances[rows, cols] <= max_distance)
+            rows, cols = rows[keep], cols[keep]
+        else:
+            rows, cols = np.nonzero(np.isfinite(distances) & (distances <= max_distance))
+        neighbours = [[] for _ in distances]  # sklearn expects one entry per row.
+        for row, col in zip(rows, cols):
+            neighbours[row].append((col, distances[row, col]))
+        return neighbours
+
+    pairs = {}
+    blocks = pairwise_distances_chunked(vectors, metric='cosine', reduce_func=reduce_block, n_jobs=jobs,
+                                        working_memory=working_memory)
+    for i, neighbours in enumerate(row for block in blocks for row in block):
+        for j, distance in neighbours:
+            pairs[(min(i, j), max(i, j))] = distance
+    return sorted((distance, filenames[i], filenames[j]) for (i, j), distance in pairs.items())
+
+
+def normalize_tokens(src):
+    """
+    Return the tokens of Python source as (token, line) pairs, with comments and
+    docstrings dropped, identifiers replaced by V, numbers by N and strings by S.
+    Tokenizing stops at the first error, so broken files yield what precedes it.
+    >>> [t for t, line in normalize_tokens("def f(x):\\n    'Doc.'\\n    return x + 1  # one\\n")]
+    ['def', 'V', '(', 'V', ')', ':', 'return', 'V', '+', 'N']
+    """
+    tokens = []
+    previous = tokenize.NEWLINE
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(src).readline):
+            kind, text, line = tok.type, tok.string, tok.start[0]
+            if kind in (tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT,
+                        tokenize.ENDMARKER):
+                pass
+            elif kind == tokenize.STRING and previous in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT):
+                pass  # A docstring, or another string alone as a statement.
+            elif kind == tokenize.NAME and not keyword.iskeyword(text):
+                tokens.append(('V', line))
+            elif kind == tokenize.NUMBER:
+                tokens.append(('N', line))
+            elif kind == tokenize.STRING:
+                tokens.append(('S', line))
+            else:
+                tokens.append((text, line))
+            if kind not in (tokenize.COMMENT, tokenize.NL):
+                previous = kind
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return tokens
+
+
+def winnow(tokens, k=5, window=4):
+    """
+    Return the fingerprints of a list of (token, line) pairs (see
+    normalize_tokens): of the hashes of each run of k tokens, the least in each
+    window of consecutive hashes, as (hash, first line, last line) tuples. Any
+    run of window + k - 1 tokens shared by two files gives them a fingerprint in
+    common.
+    >>> tokens = [(t, 1) for t in 'abcdefgh']
+    >>> len(winnow(tokens, 3, 2)) <= len(tokens) - 3 + 1
+    True
+    """
+    hashes = [(zlib.crc32(' '.join(t for t, line in tokens[i:i + k]).encode('utf-8')), tokens[i][1],
+               tokens[i + k - 1][1]) for i in range(len(tokens) - k + 1)]
+    fingerprints = []
+    last = None
+    for i in range(max(1, len(hashes) - window + 1) if hashes else 0):
+        # The rightmost least hash, so that a window sharing it with the last one selects nothing new.
+        j = min(range(i, min(i + window, len(hashes))), key=lambda j: (hashes[j][0], -j))
+        if j != last:
+            fingerprints.append(hashes[j])
+            last = j
+    return fingerprints
+
+
+def fingerprint_files(files, k=5, window=4):
+    """ Return the fingerprints (see winnow) of each of a submission's files (see
+    read_sources), as (hash, subpath, first line, last line) tuples. """
+    return [(h, subpath, first, last) for subpath, src in sorted(files.items())
+            for h, first, last in winnow(normalize_tokens(src), k, window)]
+
+
+def format_regions(matches):
+    """ Describe matching line ranges (see merge_regions) as, e.g., 'a.py:1-3=b.py:5-7 a.py:9-9=b.py:1-1'. """
+    return ' '.join('%s:%d-%d=%s:%d-%d' % r for r in merge_regions(matches))
+
+
+def merge_regions(matches):
+    """ Combine (file1, first1, last1, file2, first2, last2) matching line ranges
+    that overlap or touch in both files.
+    >>> merge_regions([('a', 1, 3, 'b', 5, 7), ('a', 3, 6, 'b', 7, 10), ('a', 20, 21, 'b', 1, 2)])
+    [('a', 1, 6, 'b', 5, 10), ('a', 20, 21, 'b', 1, 2)]
+    """
+    regions = []
+    for match in sorted(matches):
+        if regions:
+            f1, first1, last1, f2, first2, last2 = regions[-1]
+            if (f1, f2) == (match[0], match[3]) and match[1] <= last1 + 1 and first2 <= match[4] <= last2 + 1:
+                regions[-1] = (f1, first1, max(last1, match[2]), f2, first2, max(last2, match[5]))
+                continue
+        regions.append(match)
+    return regions
+
+
+# However small the class, a fingerprint is only too common to count if more than
+# this many submissions share it, so that a few students copying one source are still found.
+MIN_COMMON = 10
+
+
+def compare_winnow(sources, filenames, threshold=0.5, k=5, window=4, max_share=0.1):
+    """
+    Return the (distance, file1, file2, regions) tuples, sorted by distance, of
+    pairs of submissions (see read_sources) at least threshold similar (1 -
+    distance), where similarity is the fraction of the fingerprints (see winnow) of
+    the submission with fewer that the other shares. Pairs are found through an
+    inverted index from each fingerprint to the submissions that have it.
+    Fingerprints in more than max_share of submissions (and more than MIN_COMMON), such as
+    those of starter code, are ignored. regions lists the matching line ranges.
+    """
+    index = defaultdict(list)
+    fingerprints = []
+    for i, files in enumerate(sources):
+        hashes = set()
+        for h, subpath, first, last in fingerprint_files(files, k, window):
+            index[h].append((i, subpath, first, last))
+            hashes.add(h)
+        fingerprints.append(hashes)
+    max_postings = max(MIN_COMMON, max_share * len(sources))
+    common = set(h for h, postings in index.items()
+                 if len(set(i for i, subpath, first, last in postings)) > max_postings)
+    counts = [len(hashes - common) for hashes in fingerprints]
+    shared = defaultdict(set)
+    matches = defaultdict(list)
+    for h, postings in index.items():
+        if h in common:
+            continue
+        for (i, f1, first1, last1), (j, f2, first2, last2) in combinations(postings, 2):
+            if i == j:
+                continue
+            if i > j:
+                i, f1, first1, last1, j, f2, first2, last2 = j, f2, first2, last2, i, f1, first1, last1
+            shared[(i, j)].add(h)
+            matches[(i, j)].append((f1, first1, last1, f2, first2, last2))
+    distance_tuples = []
+    for (i, j), hashes in shared.items():
+        similarity = len(hashes) / float(min(counts[i], counts[j]))
+        if similarity >= threshold:
+            distance_tuples.append((1 - similarity, filenames[i], filenames[j], format_regions(matches[(i, j)])))
+    return sorted(distance_tuples)
+
+
+def open_archive(archive_path):
+    """ Open, creating it if need be, a SQLite archive of the winnowed fingerprints
+    (see winnow) of submissions, from this and past runs of pygrade cheat, and the
+    pairs among them that share fingerprints. Each student has at most one submission of
+    each assignment: the latest. """
+    db = sqlite3.connect(archive_path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS submissions (
+            id INTEGER PRIMARY KEY, student TEXT, assignment TEXT, content_hash TEXT, path TEXT,
+            UNIQUE (student, assignment));
+        CREATE TABLE IF NOT EXISTS fingerprints (hash INTEGER, submission INTEGER, file TEXT, first INTEGER,
+                                                 last INTEGER);
+        CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (hash);
+        CREATE INDEX IF NOT EXISTS fingerprints_submission ON fingerprints (submission);
+        CREATE TABLE IF NOT EXISTS matches (a INTEGER, b INTEGER, similarity REAL, regions TEXT,
+                                            PRIMARY KEY (a, b));
+    """)
+    return db
+
+
+def content_hash(files):
+    """ Return the SHA-1 of the subpaths and sources of a submission (see read_sources). """
+    h = hashlib.sha1()
+    for subpath, src in sorted(files.items()):
+        h.update(('%s\0%s\0' % (subpath, src)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def archive_submissions(db, students, sources, filenames, assignment, k=5, window=4):
+    """ Add the submissions of these students (see read_sources) that are new or
+    changed since they were last archived, replacing any earlier ones, and return
+    the archive ids of all their submissions and of just the new ones. """
+    ids = []
+    new_ids = []
+    for s, files, filename in zip(students, sources, filenames):
+        digest = content_hash(files)
+        row = db.execute('SELECT id, content_hash FROM submissions WHERE student = ? AND assignment = ?',
+                         (s['github_repo'], assignment)).fetchone()
+        if row and row[1] == digest:
+            ids.append(row[0])
+            continue
+        if row:
+            db.execute('DELETE FROM fingerprints WHERE submission = ?', (row[0],))
+            db.execute('DELETE FROM matches WHERE a = ? OR b = ?', (row[0], row[0]))
+            db.execute('DELETE FROM submissions WHERE id = ?', (row[0],))
+        cursor = db.execute('INSERT INTO submissions (student, assignment, content_hash, path) VALUES (?, ?, ?, ?)',
+                            (s['github_repo'], assignment, digest, filename))
+        db.executemany('INSERT INTO fingerprints VALUES (?, ?, ?, ?, ?)',
+                       [(h, cursor.lastrowid, subpath, first, last)
+                        for h, subpath, first, last in fingerprint_files(files, k, window)])
+        ids.append(cursor.lastrowid)
+        new_ids.append(cursor.lastrowid)
+    db.commit()
+    print('archived %d new or changed submissions' % len(new_ids))
+    return ids, new_ids
+
+
+def query_archive(db, new_ids, assignment, max_share=0.1):
+    """ Compare each of these newly archived submissions with every other archived
+    submission of the assignment, as compare_winnow does, by looking up their
+    fingerprints in the archive, and save every pair that shares any fingerprint,
+    however similar, so that later runs may ask for any threshold. """
+    n = db.execute('SELECT COUNT(*) FROM submissions WHERE assignment = ?', (assignment,)).fetchone()[0]
+    common = set(h for h, in db.execute(
+        'SELECT hash FROM fingerprints JOIN submissions ON submission = id WHERE assignment = ? '
+        'GROUP BY hash HAVING COUNT(DISTINCT submission) > ?', (assignment, max(MIN_COMMON, max_share * n))))
+    counts = {}
+
+    def count(i):
+        if i not in counts:
+            hashes = set(h for h, in db.execute('SELECT hash FROM fingerprints WHERE submission = ?', (i,)))
+            counts[i] = len(hashes - common)
+        return counts[i]
+
+    for i in new_ids:
+        postings = defaultdict(list)
+        for h, subpath, first, last in db.execute('SELECT hash, file, first, last FROM fingerprints '
+                                                  'WHERE submission = ?', (i,)).fetchall():
+            if h not in common:
+                postings[h].append((subpath, first, last))
+        shared = defaultdict(set)
+        matches = defaultdict(list)
+        hashes = list(postings)
+        for start in range(0, len(hashes), 500):  # SQLite limits the number of parameters.
+            chunk = hashes[start:start + 500]
+            for h, j, subpath, first, last in db.execute(
+                    'SELECT hash, submission, file, first, last FROM fingerprints JOIN submissions ON submission = id '
+                    'WHERE assignment = ? AND submission != ? AND hash IN (%s)' % ','.join('?' * len(chunk)),
+                    [assignment, i] + chunk):
+                shared[j].add(h)
+                for f1, first1, last1 in postings[h]:
+                    matches[j].append((f1, first1, last1, subpath, first, last))
+        for j, hashes_j in shared.items():
+            similarity = len(hashes_j) / float(min(count(i), count(j)))
+            regions = matches[j] if i < j else [m[3:] + m[:3] for m in matches[j]]
+            db.execute('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?)',
+                       (min(i, j), max(i, j), similarity, format_regions(regions)))
+    db.commit()
+
+
+def compare_archive(students, sources, filenames, assignment, archive_path, threshold=0.5, k=5, window=4,
+                    max_share=0.1):
+    """
+    Like compare_winnow, but keep the fingerprints of every submission in the
+    archive at archive_path (see open_archive), so that only new or changed
+    submissions are fingerprinted and compared, against all archived submissions
+    of the assignment, including those of students from earlier runs (e.g. past
+    semesters) who are not in students. Return the pairs at least threshold
+    similar that involve any of these students, whose other file is the path it
+    was archived from. Every pair that shares a fingerprint is archived, and the
+    threshold only applied here, so a later run may lower it.
+    Which fingerprints are too common to count is decided when a pair is found,
+    so pairs found earlier are not rescored as the archive grows.
+    """
+    db = open_archive(archive_path)
+    ids, new_ids = archive_submissions(db, students, sources, filenames, assignment, k, window)
+    query_archive(db, new_ids, assignment, max_share)
+    distance_tuples = []
+    ids = set(ids)
+    for a, b, similarity, regions, path_a, path_b in db.execute(
+            'SELECT a, b, similarity, regions, sa.path, sb.path FROM matches '
+            'JOIN submissions sa ON a = sa.id JOIN submissions sb ON b = sb.id WHERE similarity >= ?', (threshold,)):
+        if a in ids or b in ids:
+            distance_tuples.append((1 - similarity, path_a, path_b, regions))
+    db.close()
+    return sorted(distance_tuples)
 
 
-def compare_assignments(students, test_path, path):
-    vectors, filenames = parse_assignments(students, test_path, path)
+def compare_assignments(students, test_path, path, method='tfidf', threshold=None, top_k=None, jobs=1,
+                        archive_path=None, cache_dir=None):
+    if method == 'winnow':
+        sources, filenames = read_sources(students, test_path, path)
+        threshold = 0.5 if threshold is None else threshold
+        if archive_path:
+            assignment = ','.join(read_assignment_metadata(test_path)['files_to_test'])
+            return compare_archive(students, sources, filenames, assignment, archive_path, threshold)
+        return compare_winnow(sources, filenames, threshold)
+    if method == 'minhash':
+        strings, filenames = read_assignments(students, test_path, path, jobs, cache_dir)
+        return compare_minhash(strings, filenames, 0.5 if threshold is None else threshold)
+    vectors, filenames = parse_assignments(students, test_path, path, jobs, cache_dir)
+    if top_k or threshold is not None:
+        return nearest_pairs(vectors, filenames, top_k, threshold, jobs)
     distances = pairwise_distances(vectors, metric='cosine')
     distance_tuples = [(distances[i, j], filenames[i], filenames[j]) for i, j in combinations(range(len(filenames)), 2)]
     return sorted(distance_tuples)
@@ -68,7 +575,7 @@ def compare_assignments(students, test_path, path):
 def write_output(results, out_path):
     outf = open(out_path, 'w')
     for r in results:
-        outf.write('%.4f\t%s\t%s\n' % (r[0], r[1], r[2]))
+        outf.write('%.4f\t%s\t%s%s\n' % (r[0], r[1], r[2], '\t' + r[3] if len(r) > 3 else ''))
     outf.close()
     print('saved results in %s' % out_path)
 
@@ -79,7 +586,18 @@ def main():
     print('working directory=%s' % path)
     students = read_students(args['--students'])
     print('read %d students' % len(students))
-    results = compare_assignments(students, args['--test'], path)
+    if args['--method'] not in ['tfidf', 'minhash', 'winnow']:
+        sys.exit('unknown method %s; use tfidf, minhash or winnow' % args['--method'])
+    if args['--archive'] and args['--method'] != 'winnow':
+        sys.exit('--archive needs --method winnow')
+    if args['--top-k'] and args['--method'] != 'tfidf':
+        sys.exit('--top-k needs --method tfidf')
+    if args['--cache'] and args['--method'] == 'winnow':
+        sys.exit('--cache needs --method tfidf or minhash')
+    results = compare_assignments(students, args['--test'], path, args['--method'],
+                                  float(args['--threshold']) if args['--threshold'] else None,
+                                  int(args['--top-k']) if args['--top-k'] else None, int(args['--jobs']),
+                                  args['--archive'], args['--cache'])
     write_output(results, args['--output'])
 
 
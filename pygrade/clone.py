@@ -3,15 +3,27 @@
 """Clone student GitHub repositories.
 
 usage:
-    pygrade clone [--students <file>] [--workdir <file>]
+    pygrade clone [--students <file>] [--workdir <file>] [--jobs <n>] [--retries <n>] [--report <file>]
+                  [--test <file>] [--remote <uri>]
 
 Options
     -h, --help
+    -j, --jobs <n>                  Number of repositories to clone at once [default: 8]
+    --remote <uri>                  URL of the template repository that student repositories were created from (see
+                                    pygrade init). It is cloned once, and student clones borrow its objects.
+    -r, --retries <n>               Times to retry a clone that fails with a network error, waiting
+                                    exponentially longer each time [default: 3]
+    --report <file>                 JSON file listing the repositories cloned, skipped (already present) and
+                                    failed, with their errors [default: clone_report.json]
     -s, --students <file>           Students TSV file [default: students.tsv]
+    -t, --test <file>               Make partial clones that check out only the directories of the files this test
+                                    file grades (its @name). Repositories already cloned this way have any new
+                                    directories added.
     -w, --workdir <file>            Temporary directory for storing assignments [default: students]
 """
 from docopt import docopt
-from . import clone_repos, read_students
+import json
+from . import clone_repos, read_assignment_metadata, read_students, sparse_dirs, update_reference_repo
 
 
 def main():
@@ -20,7 +32,14 @@ def main():
     print('working directory=%s' % path)
     students = read_students(args['--students'])
     print('read %d students' % len(students))
-    clone_repos(students, path)
+    sparse = sparse_dirs(read_assignment_metadata(args['--test'])['files_to_test']) if args['--test'] else None
+    reference = update_reference_repo(args['--remote'], path) if args['--remote'] else None
+    report = clone_repos(students, path, jobs=int(args['--jobs']), retries=int(args['--retries']), sparse=sparse,
+                         reference=reference)
+    with open(args['--report'], 'w') as f:
+        json.dump(report, f, indent=2)
+    print('cloned %d, skipped %d, failed %d; see %s' % (len(report['cloned']), len(report['skipped']),
+                                                        len(report['failed']), args['--report']))
 
 
 if __name__ == '__main__':
@@ -4,29 +4,81 @@
 
 usage:
     pygrade grade --test <file> [--students <file>] [--output <file>] [--workdir <file>] [--pull] [--extra <file>]
+                  [--jobs <n>] [--cache <file>] [--preload <modules>] [--test-jobs <n>] [--resume]
+                  [--profile <dir>] [--ref <ref>] [--before <time>] [--pull-jobs <n>] [--queue-size <n>]
+                  [--check-jobs <n>]
 
 Options
     -h, --help
+    -b, --before <time>             Grade the last commit before this time, e.g. "2026-10-01 23:59". Implies reading
+                                    assignment files from git objects, as with --ref.
+    --check-jobs <n>                With --pull, number of remotes to check at once for new commits before pulling.
+                                    Only repositories whose remote has moved since they were last pulled (or
+                                    fetched, with --ref), as recorded in <workdir>/.last_pulled.json, are updated.
+                                    [default: 16]
+    -c, --cache <file>              Cache of previous results. Students whose commit, assignment files, extra deductions
+                                    and test file are unchanged since they were cached are not graded again.
     -e, --extra <file>              File containing extra deductions, in tab-separated format: github_id points_off reason
+    -j, --jobs <n>                  Number of students to grade in parallel, each in its own process [default: 1]
     -o, --output <file>             Output file [default: grades.json]
-    -p, --pull                      Pull latest code from student repository.
+    -p, --pull                      Pull latest code from student repository. Repositories are pulled by a pool of
+                                    threads, ahead of the students being graded.
+    --pull-jobs <n>                 Number of repositories to pull at once [default: 4]
+    -q, --queue-size <n>            Most students that may be pulled ahead of grading, or graded ahead of being
+                                    written to the output file [default: 16]
+    --ref <ref>                     Read assignment files from this commit of each student's repository (e.g. HEAD
+                                    or origin/master) straight from git's object database, without checking it out.
+                                    With --pull, repositories are fetched rather than pulled. Defaults to HEAD, or
+                                    with --pull, to the upstream branch of HEAD (@{upstream}), which fetching updates.
+    -r, --resume                    Resume an interrupted run, keeping the grades already saved in its journal
+                                    (the output file with a .journal suffix), and grading only the other students.
+    --profile <dir>                 Profile the import and tests of each student, saving <dir>/<github_id>.pstats
+                                    and, over all students, <dir>/all.pstats. See pygrade summarize --profile.
+    --preload <modules>             Comma-separated modules (e.g. numpy,sklearn) to import once in a fork server,
+                                    which then forks a process to grade each student. Modules imported by the
+                                    test file are preloaded as well.
     -s, --students <file>           Students TSV file [default: students.tsv]
     -t, --test <file>               File containing python tests for grading
+    --test-jobs <n>                 Number of processes running each student's tests in parallel [default: 1]
     -w, --workdir <file>            Temporary directory for storing assignments [default: students]
 """
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
+import ast
+import cProfile
+import hashlib
 import importlib
+import importlib.abc
+import importlib.util
 import inspect
 import json
+import marshal
+import math
+import multiprocessing
+from multiprocessing.connection import wait
 import os
+import pstats
+import queue
 import re
+import shutil
+import signal
 import sys
+import tempfile
+import threading
 import traceback
 import time
+import types
 import unittest
 
-from . import get_local_repo, path2name, pull_repo, read_assignment_metadata, read_students
+try:
+    import resource
+except ImportError:  # Not available on Windows; resource limits are not enforced.
+    resource = None
+
+from . import LIMITS, fetch_repo, find_changed_repos, get_head_sha, get_local_repo, hash_file, path2name, \
+    pull_repo, read_assignment_metadata, read_blobs, read_last_pulled, read_students, resolve_commit, sparse_dirs, \
+    widen_sparse_checkout, write_last_pulled
 
 
 def import_file_as_module(path):
@@ -36,36 +88,371 @@ def import_file_as_module(path):
     return loader.load_module()
 
 
-def _run_tests(test_path):
-    """ Run the unit tests in this file and return the results. """
-    test_module = import_file_as_module(test_path)
+class SourceStringLoader(importlib.abc.SourceLoader):
+    """ Loads a module from source code in memory, e.g. a file read from a git commit. """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+
+    def get_filename(self, fullname):
+        return self.path
+
+    def get_data(self, path):
+        return self.source
+
+
+def import_source_as_module(path, source):
+    """ Return a module made from this source code, as though it were the python file at path. """
+    module_name = path2name(path)
+    loader = SourceStringLoader(path, source)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(module_name, loader, origin=path))
+    sys.modules[module_name] = module
+    try:
+        loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    return module
+
+
+def import_code_as_module(path, code):
+    """ Return a module by executing code that was compiled from the python file at path. """
+    module = types.ModuleType(path2name(path))
+    module.__file__ = path
+    sys.modules[module.__name__] = module
+    exec(code, module.__dict__)
+    return module
+
+
+class TimeLimitExceeded(BaseException):
+    """ Raised inside student code that runs past its time limit. This is not an
+    Exception, so that a bare "except Exception" in student code cannot swallow it. """
+    pass
+
+
+def _raise_time_limit(message):
+    def handler(signum, frame):
+        raise TimeLimitExceeded(message)
+    return handler
+
+
+def lookup_test(tests, test):
+    """ Return the entry in the index of tests (see index_tests) for this TestCase,
+    or None if its method is not defined in the test file. """
+    name = getattr(test, '_testMethodName', None)
+    for cls in type(test).__mro__:
+        entry = tests.get('%s.%s' % (cls.__name__, name))
+        if entry:
+            return entry
+    return None
+
+
+def read_proc_status(field):
+    """ Return a field of /proc/self/status, in kilobytes, e.g. VmRSS, or None if it cannot be read. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+# The highest peak resident memory, in kilobytes, that reset_peak_rss has cleared.
+_cleared_peak_rss = 0
+
+
+def reset_peak_rss():
+    """ Reset the peak resident memory of this process to its current resident
+    memory, and return that in kilobytes, or None if this is not possible (it
+    needs Linux's /proc/self/clear_refs). """
+    global _cleared_peak_rss
+    peak = read_proc_status('VmHWM')
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return None
+    _cleared_peak_rss = max(_cleared_peak_rss, peak or 0)
+    return read_proc_status('VmRSS')
+
+
+def max_rss():
+    """ Return the peak resident memory of this process so far, in kilobytes,
+    including any peak cleared by reset_peak_rss, or None if unknown. """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max(rss // 1024 if sys.platform == 'darwin' else rss, _cleared_peak_rss)
+
+
+class GradingResult(unittest.TestResult):
+    """
+    A TestResult that interrupts each test once it has run longer than its timeout:
+    the @timeout of the test in the index of tests, or else the default timeout.
+    It also records, in stats, a (test, record) pair for each test run, where the
+    record has the test's name, status (pass, fail, error, timeout or skip), wall
+    and CPU time in seconds, and memory: the peak resident memory of the test, in
+    kilobytes over what the process had when it started, or None where the peak
+    cannot be reset (see reset_peak_rss).
+    """
+
+    def __init__(self, timeout=None, tests=None):
+        super(GradingResult, self).__init__()
+        self.timeout = timeout
+        self.tests = tests or {}
+        self.stats = []
+        self._alarm = False
+
+    def startTest(self, test):
+        super(GradingResult, self).startTest(test)
+        self._status = 'pass'
+        self._start = (time.perf_counter(), time.process_time(), reset_peak_rss())
+        entry = lookup_test(self.tests, test)
+        timeout = entry['timeout'] if entry and entry['timeout'] else self.timeout
+        if timeout and hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGALRM,
+                          _raise_time_limit('test exceeded time limit of %g seconds' % timeout))
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            self._alarm = True
+
+    def stopTest(self, test):
+        if self._alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            self._alarm = False
+        wall, cpu, rss = self._start
+        peak = read_proc_status('VmHWM') if rss is not None else None
+        self.stats.append((test, {'name': test._testMethodName,
+                                  'status': self._status,
+                                  'wall_time': round(time.perf_counter() - wall, 4),
+                                  'cpu_time': round(time.process_time() - cpu, 4),
+                                  'memory': max(0, peak - rss) if peak is not None else None}))
+        super(GradingResult, self).stopTest(test)
+
+    def _set_status(self, test, err):
+        if err is None:
+            return
+        if issubclass(err[0], test.failureException):
+            self._status = 'fail'
+        elif issubclass(err[0], TimeLimitExceeded):
+            self._status = 'timeout'
+        else:
+            self._status = 'error'
+
+    def addFailure(self, test, err):
+        super(GradingResult, self).addFailure(test, err)
+        self._set_status(test, err)
+
+    def addError(self, test, err):
+        super(GradingResult, self).addError(test, err)
+        if isinstance(test, unittest.TestCase):  # Not an error in a class or module fixture.
+            self._set_status(test, err)
+
+    def addSubTest(self, test, subtest, err):
+        super(GradingResult, self).addSubTest(test, subtest, err)
+        self._set_status(test, err)
+
+    def addSkip(self, test, reason):
+        super(GradingResult, self).addSkip(test, reason)
+        self._status = 'skip'
+
+
+def _flatten(suite):
+    """ Yield the individual test cases of a (possibly nested) test suite. """
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in _flatten(test):
+                yield t
+        else:
+            yield test
+
+
+def _split_tests(tests):
+    """ Split a list of tests into units of work, as lists of indices into tests.
+    All tests of a TestCase class with class-level fixtures form one unit, so the
+    fixtures are set up once; every other test is a unit by itself. """
+    units = []
+    class2unit = {}
+    for k, test in enumerate(tests):
+        cls = type(test)
+        if (cls.setUpClass.__func__ is unittest.TestCase.setUpClass.__func__ and
+                cls.tearDownClass.__func__ is unittest.TestCase.tearDownClass.__func__):
+            units.append([k])
+        else:
+            if cls not in class2unit:
+                class2unit[cls] = len(units)
+                units.append([])
+            units[class2unit[cls]].append(k)
+    return units
+
+
+def _test_worker(conn, tests, units, counter, timeout, index, profile_path=None):
+    """ Entry point of a process running part of one student's tests. Repeatedly
+    claims the next unit of tests, runs it, and sends the unit back along with its
+    failures and errors, as (index of test, description of test, message) tuples,
+    and its stats, as (index of test, record) pairs. If profile_path is given, the
+    tests are profiled and the profile saved to profile_path.<process id>. """
+    profiler = cProfile.Profile() if profile_path else None
+    try:
+        if profiler:
+            profiler.enable()
+        result = GradingResult(timeout, index)
+        position = dict((id(test), k) for k, test in enumerate(tests))
+        while True:
+            with counter.get_lock():
+                u = counter.value
+                counter.value += 1
+            if u >= len(units):
+                break
+            nfailures, nerrors, nstats = len(result.failures), len(result.errors), len(result.stats)
+            unittest.TestSuite(tests[k] for k in units[u]).run(result)
+            conn.send((units[u],
+                       [(position.get(id(t)), str(t), msg) for t, msg in result.failures[nfailures:]],
+                       [(position.get(id(t)), str(t), msg) for t, msg in result.errors[nerrors:]],
+                       [(position[id(t)], record) for t, record in result.stats[nstats:]]))
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats('%s.%d' % (profile_path, os.getpid()))
+        conn.close()
+
+
+def _run_suite_in_parallel(suite, timeout, test_jobs, index, profiler=None):
+    """
+    Run the tests of this suite in up to test_jobs processes forked from this one.
+    Return a GradingResult whose failures and errors are in the same order as if
+    the suite had been run in this process. A test whose process died before
+    reporting it counts as an error. If profiler is given, the profiles of the
+    processes are added to it.
+    """
+    tests = list(_flatten(suite))
+    units = _split_tests(tests)
+    ctx = multiprocessing.get_context('fork')
+    counter = ctx.Value('i', 0)
+    profile_tmpdir = tempfile.mkdtemp(prefix='pygrade-') if profiler else None
+    profile_path = os.path.join(profile_tmpdir, 'tests.pstats') if profiler else None
+    running = {}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for _ in range(min(test_jobs, len(units))):
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_test_worker, args=(send_conn, tests, units, counter, timeout, index, profile_path))
+        proc.start()
+        send_conn.close()
+        running[recv_conn] = proc
+    done = set()
+    outcomes = {'failures': [], 'errors': []}
+    stats = []
+    exit_message = None
+    while running:
+        for conn in wait(list(running)):
+            try:
+                unit, failures, errors, unit_stats = conn.recv()
+            except EOFError:
+                proc = running.pop(conn)
+                conn.close()
+                proc.join()
+                if proc.exitcode:
+                    exit_message = _describe_exit(proc.exitcode)
+                elif profiler:
+                    profiler.add('%s.%d' % (profile_path, proc.pid))
+                continue
+            done.update(unit)
+            outcomes['failures'].extend(failures)
+            outcomes['errors'].extend(errors)
+            stats.extend(unit_stats)
+    if profile_tmpdir:
+        shutil.rmtree(profile_tmpdir)
+    outcomes['errors'].extend((k, str(test), 'test was not run: %s' % exit_message)
+                              for k, test in enumerate(tests) if k not in done)
+
+    result = GradingResult(timeout, index)
+    result.testsRun = len(tests)
+    result.stats = [(tests[k], record) for k, record in sorted(stats, key=lambda x: x[0])]
+    for kind, found in outcomes.items():
+        seen = set()
+        for k, description, msg in sorted(found, key=lambda x: (len(tests) if x[0] is None else x[0], x[1])):
+            if k is None:
+                # An error outside any test, e.g. in setUpClass, may be reported by several processes.
+                if description in seen:
+                    continue
+                seen.add(description)
+            getattr(result, kind).append((tests[k] if k is not None else
+                                          unittest.suite._ErrorHolder(description), msg))
+    return result
+
+
+def _run_tests(test_path, timeout=None, test_code=None, test_jobs=1, tests=None, profiler=None):
+    """ Run the unit tests in this file and return the results.
+    Each test is stopped after timeout seconds, unless it sets its own @timeout
+    in tests, the index of the test file.
+    If test_code is given, it is the already compiled test file.
+    If test_jobs > 1, the tests are split across that many forked processes.
+    If profiler is given, a pstats.Stats, the profile of importing and running
+    the tests is added to it. """
+    test_profiler = cProfile.Profile() if profiler else None
+    if test_profiler:
+        test_profiler.enable()
+    if test_code is not None:
+        test_module = import_code_as_module(test_path, test_code)
+    else:
+        test_module = import_file_as_module(test_path)
     suite = unittest.TestLoader().loadTestsFromModule(test_module)
-    test_results = unittest.TestCase().defaultTestResult()
-    return suite.run(test_results)
+    if test_jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        if test_profiler:
+            # The processes running the tests profile themselves.
+            test_profiler.disable()
+        test_results = _run_suite_in_parallel(suite, timeout, test_jobs, tests, profiler)
+    else:
+        test_results = suite.run(GradingResult(timeout, tests))
+    if test_profiler:
+        test_profiler.disable()
+        profiler.add(test_profiler)
+    return test_results
 
 
-def deduct_failures(test_results):
-    """ Accumulate each failed tests and the points lost."""
+def deduct_failures(test_results, tests=None):
+    """ Accumulate each failed tests and the points lost.
+    Points, docstrings and source are read from tests, the index of the test file
+    (see index_tests), falling back to inspecting tests that are not in it. """
     deductions = []
     for failure in test_results.failures + test_results.errors:
         msg = failure[1]
-        match = re.search(r'\@points\s*=\s*([0-9\.]+)', failure[0]._testMethodDoc)
-        points = float(match.group(1)) if match else 0
-        source = ' '.join(inspect.getsourcelines(getattr(failure[0], failure[0]._testMethodName))[0])
-        deduction = {'summary': '%s%s' % (failure[0]._testMethodName,
-                                          ': ' + failure[0]._testMethodDoc
-                                          if failure[0]._testMethodDoc else ''),
+        entry = lookup_test(tests or {}, failure[0])
+        if entry:
+            name, doc, source = failure[0]._testMethodName, entry['doc'], entry['source']
+            points = entry['points'] or 0
+        elif hasattr(failure[0], '_testMethodName'):
+            name, doc = failure[0]._testMethodName, failure[0]._testMethodDoc
+            match = re.search(r'\@points\s*=\s*([0-9\.]+)', doc or '')
+            points = float(match.group(1)) if match else 0
+            source = ' '.join(inspect.getsourcelines(getattr(failure[0], name))[0])
+        else:  # An error outside any test, e.g. in setUpClass.
+            name, doc, points, source = str(failure[0]), None, 0, ''
+        deduction = {'summary': '%s%s' % (name, ': ' + doc if doc else ''),
                      'trace': '%s\nsource:\n%s' % (msg, source),
                      'points': points}
         deductions.append(deduction)
     return deductions
 
 
-def load_assignment_modules(repo, assignment_subpaths, metadata, result, results):
+def load_assignment_modules(repo, assignment_subpaths, metadata, result, results, commit=None):
+    """ Import each assignment file, from the working tree of the repo, or if commit
+    is given, from that commit. If one cannot be imported, give the result 0 points
+    and return False. """
+    blobs = read_blobs(repo, commit, assignment_subpaths) if commit else None
     for assignment_subpath in assignment_subpaths:
         assignment_path = os.path.join(repo, assignment_subpath)
         try:
-            import_file_as_module(assignment_path)
+            if commit is None:
+                import_file_as_module(assignment_path)
+            elif blobs[assignment_subpath] is None:
+                raise FileNotFoundError('%s is not in commit %s' % (assignment_subpath, commit))
+            else:
+                # The commit is part of the path so tracebacks do not show lines of the working tree's copy.
+                import_source_as_module('%s@%s' % (assignment_path, commit[:12]), blobs[assignment_subpath])
         except Exception as e:  # Compiler error or file not present.
             exc_type, exc_value, exc_traceback = sys.exc_info()
             result['deductions'] = [{'summary': 'cannot import %s' % assignment_subpath,
@@ -87,45 +474,608 @@ def unload_assignment_modules(repo, assignment_subpaths, test_path):
     return True
 
 
-def run_tests(students, test_path, path, do_pull, student2extra):
+def new_result(s, metadata):
+    """ Return the result dictionary for this student, before any grading. """
+    return {'student': s, 'assignment': metadata['files_to_test'],
+            'time_graded': time.asctime(),
+            'possible_points': metadata['possible_points']}
+
+
+def failed_result(s, metadata, summary, trace=''):
+    """ Return a result giving this student 0 points, for a reason that
+    prevented their tests from running at all. """
+    result = new_result(s, metadata)
+    result['deductions'] = [{'summary': summary,
+                             'trace': trace,
+                             'points': metadata['possible_points']}]
+    result['grade'] = 0
+    return result
+
+
+def get_profile_path(profile_dir, s):
+    """ Return the path of the profile of grading this student. """
+    return os.path.join(profile_dir, '%s.pstats' % s['github_id'])
+
+
+def grade_student(s, test_path, path, metadata, extra, test_code=None, test_jobs=1, profile_dir=None, commit=None):
+    """ Import one student's assignment files, run the unit tests against them,
+    and return the result dictionary for that student. Besides the grade, the
+    result has the seconds spent importing and testing, under 'timing', and the
+    stats of each test (see GradingResult), under 'tests'.
+    If profile_dir is given, the import and tests are profiled, and the profile
+    saved in that directory (see get_profile_path).
+    If commit is given, the assignment files are read from that commit, which is
+    recorded in the result. """
+    assignment_subpaths = metadata['files_to_test']
+    result = new_result(s, metadata)
+    repo = get_local_repo(s, path)
+    profiler = None
+    start = time.perf_counter()
+    if profile_dir:
+        import_profiler = cProfile.Profile()
+        loaded = import_profiler.runcall(load_assignment_modules, repo, assignment_subpaths, metadata, result, [],
+                                         commit)
+        profiler = pstats.Stats(import_profiler)
+    else:
+        loaded = load_assignment_modules(repo, assignment_subpaths, metadata, result, [], commit)
+    timing = {'import': round(time.perf_counter() - start, 4)}
+    if loaded:
+        start = time.perf_counter()
+        test_results = _run_tests(test_path, metadata['test_timeout'], test_code, test_jobs, metadata['tests'],
+                                  profiler)
+        timing['tests'] = round(time.perf_counter() - start, 4)
+    if profiler:
+        profiler.dump_stats(get_profile_path(profile_dir, s))
+    if commit:
+        result['commit'] = commit
+    if not loaded:
+        # Could not load an assignment file. Give 0 points and continue.
+        result['timing'] = timing
+        return result
+    result['deductions'] = deduct_failures(test_results, metadata['tests']) + extra
+    result['grade'] = max(0, metadata['possible_points'] - sum(d['points'] for d in result['deductions']))
+    result['timing'] = timing
+    result['tests'] = [record for test, record in test_results.stats]
+    unload_assignment_modules(repo, assignment_subpaths, test_path)
+    return result
+
+
+def set_limits(metadata):
+    """ Limit the memory and CPU time of the current process, as set in the test file. """
+    if resource is None:
+        return
+    if metadata['memory_limit']:
+        nbytes = int(metadata['memory_limit'] * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+    if metadata['cpu_limit']:
+        # Exceeding the soft limit interrupts the current test; the hard limit kills the process.
+        seconds = int(math.ceil(metadata['cpu_limit']))
+        signal.signal(signal.SIGXCPU,
+                      _raise_time_limit('exceeded CPU time limit of %d seconds' % seconds))
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 5))
+
+
+def _grade_worker(conn, s, test_path, path, metadata, extra, test_code=None, test_jobs=1, profile_dir=None,
+                  commit=None):
+    """ Entry point of a grading process: grade one student and send the result
+    back to the parent. test_code is the test file compiled and marshalled by the parent. """
+    try:
+        if hasattr(os, 'setpgid'):
+            # Lead a new process group, so any test processes are killed along with this one.
+            os.setpgid(0, 0)
+        set_limits(metadata)
+        if test_code is not None:
+            test_code = marshal.loads(test_code)
+        conn.send(grade_student(s, test_path, path, metadata, extra, test_code, test_jobs, profile_dir, commit))
+    finally:
+        conn.close()
+
+
+def get_test_imports(test_path, metadata):
+    """ Return the names of the modules imported by the test file, other than the
+    assignment files themselves. """
+    assignment_modules = set(path2name(p) for p in metadata['files_to_test'])
+    names = []
+    for node in ast.walk(ast.parse(open(test_path).read(), test_path)):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+    return [n for n in names if n.split('.')[0] not in assignment_modules]
+
+
+def get_fork_server(modules):
+    """ Return a multiprocessing context whose processes are forked from a server
+    process that has already imported these modules. Falls back to the default
+    context where fork servers are not supported. """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload([__name__] + list(modules))
+    return ctx
+
+
+def _kill(proc):
+    """ Kill a grading process along with any test processes it started. """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (AttributeError, OSError):  # No process groups, or it has not made its own yet.
+        proc.kill()
+    proc.join()
+
+
+def _describe_exit(exitcode):
+    """ Explain why a grading process died without returning a result.
+    >>> _describe_exit(-9)
+    'grading process was killed by SIGKILL (out of memory?)'
+    """
+    if exitcode is not None and exitcode < 0:
+        name = signal.Signals(-exitcode).name
+        if name == 'SIGKILL':
+            return 'grading process was killed by SIGKILL (out of memory?)'
+        elif name == 'SIGXCPU':
+            return 'grading process exceeded its CPU time limit'
+        return 'grading process was killed by %s' % name
+    return 'grading process exited with code %s' % exitcode
+
+
+def _run_parallel(tasks, jobs, ctx, lost=None):
+    """
+    Grade each (index, args, result) task in its own process, running at most jobs
+    processes at a time. Yield (index, result) pairs in order of completion.
+    Tasks that already have a result are yielded without being graded.
+    A process that runs longer than the test file's @student_timeout is killed,
+    and a student whose process dies gets a result with 0 points. If lost is a
+    set, the index of each such student is added to it.
+    """
+    tasks = iter(tasks)
+    running = {}
+    lost = set() if lost is None else lost
+    try:
+        for indexed_result in _schedule(tasks, jobs, ctx, running, lost):
+            yield indexed_result
+    finally:
+        # Stop any processes left running if grading is interrupted.
+        for conn, (i, proc, student, metadata, deadline) in running.items():
+            _kill(proc)
+            conn.close()
+
+
+def _schedule(tasks, jobs, ctx, running, lost):
+    """ Start and collect grading processes for _run_parallel; running maps the
+    connection of each running process to (index, process, student, metadata, deadline). """
+    while True:
+        while len(running) < jobs:
+            task = next(tasks, None)
+            if task is None:
+                break
+            i, args, result = task
+            if result is not None:
+                yield i, result
+                continue
+            metadata = args[3]
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_grade_worker, args=(send_conn,) + args)
+            proc.start()
+            send_conn.close()
+            deadline = time.time() + metadata['student_timeout'] if metadata['student_timeout'] else None
+            running[recv_conn] = (i, proc, args[0], metadata, deadline)
+        if not running:
+            return
+        deadlines = [r[4] for r in running.values() if r[4] is not None]
+        timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+        ready = wait(list(running), timeout)
+        for conn in ready:
+            i, proc, student, metadata, deadline = running.pop(conn)
+            try:
+                result = conn.recv()
+            except EOFError:
+                result = None
+            conn.close()
+            proc.join()
+            if result is None:
+                lost.add(i)
+                result = failed_result(student, metadata, _describe_exit(proc.exitcode))
+            yield i, result
+        for conn, (i, proc, student, metadata, deadline) in list(running.items()):
+            if deadline is not None and time.time() >= deadline:
+                _kill(proc)
+                conn.close()
+                del running[conn]
+                lost.add(i)
+                yield i, failed_result(student, metadata, 'grading exceeded time limit of %g seconds' %
+                                       metadata['student_timeout'])
+
+
+def _in_order(indexed_results):
+    """ Reorder (index, result) pairs so results are yielded by increasing index.
+    >>> list(_in_order([(1, 'b'), (2, 'c'), (0, 'a')]))
+    ['a', 'b', 'c']
+    """
+    pending = {}
+    next_index = 0
+    for i, result in indexed_results:
+        pending[i] = result
+        while next_index in pending:
+            yield pending.pop(next_index)
+            next_index += 1
+
+
+class QueueStats(object):
+    """ Samples the number of items waiting in the queue between two stages of
+    grading. A queue that is usually full means the stage after it is the
+    bottleneck; one that is usually empty means the stage before it is.
+    >>> stats = QueueStats('write', 4)
+    >>> for depth in [0, 2, 4]:
+    ...     stats.sample(depth)
+    >>> stats.summary()
+    'write queue: mean depth 2.0, max 4 of 4, full 33% of the time'
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+        self.full = 0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+        self.full += depth >= self.size
+
+    def summary(self):
+        return '%s queue: mean depth %.1f, max %d of %d, full %d%% of the time' % (
+            self.name, self.total / max(1, self.samples), self.max, self.size, 100 * self.full / max(1, self.samples))
+
+
+def _prefetch(items, func, workers, size, stats):
+    """
+    Call func on each item in a pool of workers threads, and yield each item, in
+    order, once func has returned for it. At most size items are worked on or
+    waiting ahead of the consumer.
+    >>> list(_prefetch(range(5), lambda i: None, 2, 3, QueueStats('test', 3)))
+    [0, 1, 2, 3, 4]
+    """
+    items = iter(items)
+    pool = ThreadPoolExecutor(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= size:
+                break
+        while pending:
+            stats.sample(sum(1 for item, future in pending if future.done()))
+            item, future = pending.popleft()
+            future.result()
+            for next_item in items:
+                pending.append((next_item, pool.submit(func, next_item)))
+                break  # Keep size items pending.
+            yield item
+    finally:
+        # Drop work not yet started if grading is interrupted.
+        for item, future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def _write_behind(write, items, size, stats):
+    """ Call write on each item in a separate thread, so the producer of items may
+    run up to size items ahead. Items already produced are all written, even if
+    producing the rest fails. """
+    q = queue.Queue(size)
+    errors = []
+    done = object()
+
+    def writer():
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if not errors:
+                try:
+                    write(item)
+                except BaseException as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for item in items:
+            if errors:
+                break
+            stats.sample(q.qsize())
+            q.put(item)
+    finally:
+        q.put(done)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def cache_key(repo, test_path, metadata, extra, commit=None):
+    """ Return a key identifying everything that determines a student's result: the
+    commit and contents of their assignment files, the test file, and their extra deductions.
+    If commit is given, the assignment files are the ones in that commit. """
+    if commit:
+        files = []
+    else:
+        commit = get_head_sha(repo)
+        files = [hash_file(os.path.join(repo, subpath)) for subpath in metadata['files_to_test']]
+    key = [commit, hash_file(test_path), extra, files]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_cache(cache_path):
+    """ Read the grading cache, a file of JSON lines, each with a student's
+    github_id, cache key and result. Later lines replace earlier ones. """
+    cache = {}
+    if os.path.exists(cache_path):
+        for line in open(cache_path):
+            try:
+                entry = json.loads(line)
+            except ValueError:  # Partial line left by an interrupted run.
+                continue
+            cache[entry['github_id']] = entry
+    return cache
+
+
+def write_cache(cache, cache_path):
+    """ Rewrite the grading cache with one line per student. """
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as outf:
+        for github_id, entry in sorted(cache.items()):
+            outf.write(json.dumps(entry) + '\n')
+    os.replace(tmp_path, cache_path)
+
+
+def run_tests(students, test_path, path, do_pull, student2extra, jobs=1, cache_path=None, preload=None,
+              test_jobs=1, prior=None, profile_dir=None, ref=None, before=None, pull_jobs=4, queue_size=16,
+              check_jobs=16):
     """
     Run unit tests and deduct points for each failed test.
-    Return a dictionary of results for each student.
+    Yield a dictionary of results for each student, in the order of students.
+    If jobs > 1, or the test file sets resource limits, each student is graded in a
+    separate process, with up to jobs processes running at once.
+    If cache_path is given, students whose cache key is unchanged get their cached
+    result, and the cache is updated with the results of everyone else.
+    If preload is a list of module names, each student is graded in a process forked
+    from a server that has imported those modules and the test file's imports, so
+    their import time is paid only once.
+    If test_jobs > 1, each student's tests are split across that many processes
+    (forked from a separate grading process if do_pull).
+    prior maps the github_id of students who have already been graded to their result.
+    If profile_dir is given, each student's import and tests are profiled; see
+    grade_student and merge_profiles.
+    If ref or before is given, assignment files are read from the commit they name
+    (see resolve_commit) rather than from the working tree, which is left untouched:
+    with do_pull, repositories are fetched rather than pulled. Otherwise, sparse
+    clones (see clone_repos) have any directories of the assignment files that
+    they lack added to their checkout.
+    With do_pull, repositories are updated by pull_jobs threads, at most queue_size
+    students ahead of grading, and only if their remote has moved since they were
+    last updated (see find_changed_repos, which runs check_jobs at a time).
     FIXME: check for errors?
     """
     metadata = read_assignment_metadata(test_path)
-    assignment_subpaths = metadata['files_to_test']
-    results = []
-    for s in students:
-        print('grading %s' % str(s))
-        sys.stdout.flush()
-        result = {'student': s, 'assignment': assignment_subpaths,
-                  'time_graded': time.asctime(),
-                  'possible_points': metadata['possible_points']}
+    for name, test in sorted(metadata['tests'].items()):
+        if test['points'] is None:
+            print('warning: %s has no @points, so failing it deducts 0 points' % name)
+    isolate = jobs > 1 or preload is not None or any(metadata[key] for key in LIMITS if key != 'test_timeout')
+    # Test processes are forked from whatever process grades, which must not be
+    # this one while pulling threads run; see below.
+    isolate = isolate or (do_pull and test_jobs > 1)
+    if preload is not None:
+        ctx = get_fork_server(preload + get_test_imports(test_path, metadata))
+        test_code = marshal.dumps(compile(open(test_path).read(), test_path, 'exec'))
+    elif do_pull:
+        # Forking while pulling threads run could leave locks held in the child.
+        ctx = get_fork_server([])
+        test_code = None
+    else:
+        ctx = multiprocessing.get_context()
+        test_code = None
+    cache = read_cache(cache_path) if cache_path else None
+    new_keys = {}
+    lost = set()
+    prior = prior or {}
+    from_git = bool(ref or before)
+    if from_git and do_pull and not ref:
+        # Fetching does not move HEAD, so grade what was fetched: the branch HEAD tracks.
+        ref = '@{upstream}'
+    pull_stats = QueueStats('pull', queue_size)
+    dirs = sparse_dirs(metadata['files_to_test'])
+
+    def update(s):
+        if s['github_id'] in prior:
+            return
         repo = get_local_repo(s, path)
-        if do_pull:
+        if s['github_id'] not in changed:
+            print('unchanged since last pull: %s' % s['github_repo'])
+            updated = True
+        elif from_git:
+            print('fetching %s' % s['github_repo'])
+            updated = fetch_repo(repo)
+        else:
             print('pulling %s' % s['github_repo'])
-            pull_repo(repo)
-        if not load_assignment_modules(repo, assignment_subpaths, metadata, result, results):
-            # Could not load an assignment file. Give 0 points and continue.
+            updated = pull_repo(repo)
+        if updated and changed.get(s['github_id']):
+            last_pulled['fetch'][s['github_id']] = changed[s['github_id']]
+            if not from_git:
+                last_pulled['pull'][s['github_id']] = changed[s['github_id']]
+        if not from_git:
+            widen_sparse_checkout(repo, dirs)
+
+    if do_pull:
+        last_pulled = read_last_pulled(path)
+        changed = find_changed_repos([s for s in students if s['github_id'] not in prior], path,
+                                     last_pulled['fetch' if from_git else 'pull'], check_jobs)
+        print('%d of %d repositories have changed since last pulled' % (len(changed), len(students) - len(prior)))
+
+    def tasks():
+        pulled = _prefetch(students, update, pull_jobs, queue_size, pull_stats) if do_pull else students
+        for i, s in enumerate(pulled):
+            if s['github_id'] in prior:
+                yield i, None, prior[s['github_id']]
+                continue
+            print('grading %s' % str(s))
+            sys.stdout.flush()
+            repo = get_local_repo(s, path)
+            if not do_pull and not from_git:
+                widen_sparse_checkout(repo, dirs)
+            commit = resolve_commit(repo, ref or 'HEAD', before) if from_git else None
+            if from_git and not commit:
+                yield i, None, failed_result(s, metadata, 'no commit %s%s' % (ref or 'HEAD',
+                                                                              ' before %s' % before if before else ''))
+                continue
+            extra = student2extra[s['github_id']]
+            if cache is not None:
+                key = cache_key(repo, test_path, metadata, extra, commit)
+                entry = cache.get(s['github_id'])
+                if entry and entry['key'] == key:
+                    print('  unchanged; using cached result')
+                    yield i, None, entry['result']
+                    continue
+                new_keys[s['github_id']] = key
+            yield i, (s, test_path, path, metadata, extra, test_code, test_jobs, profile_dir, commit), None
+
+    if isolate:
+        results = _in_order(_run_parallel(tasks(), jobs, ctx, lost))
+    else:
+        results = (result if result is not None else grade_student(*args) for i, args, result in tasks())
+
+    if do_pull:
+        results = _report_after(results, pull_stats)
+        results = _save_last_pulled_after(results, path, last_pulled)
+    if cache is None:
+        for result in results:
             yield result
-            continue
-        test_results = _run_tests(test_path)
-        result['deductions'] = deduct_failures(test_results) + student2extra[s['github_id']]
-        result['grade'] = max(0, metadata['possible_points'] - sum(d['points'] for d in result['deductions']))
-        results.append(result)
-        unload_assignment_modules(repo, assignment_subpaths, test_path)
-        yield result
+        return
+    with open(cache_path, 'a') as cache_file:
+        for i, result in enumerate(results):
+            github_id = result['student']['github_id']
+            # A process killed or dead (e.g. under load, or out of memory), or a test
+            # cut off at its time limit, may not fail next time.
+            if i in lost or any(t['status'] == 'timeout' for t in result.get('tests', [])):
+                new_keys.pop(github_id, None)
+            if github_id in new_keys:
+                entry = {'github_id': github_id, 'key': new_keys.pop(github_id), 'result': result}
+                cache[github_id] = entry
+                cache_file.write(json.dumps(entry) + '\n')
+                cache_file.flush()
+            yield result
+    write_cache(cache, cache_path)
+
+
+def _report_after(items, stats):
+    """ Yield each item, then print the summary of stats. """
+    for item in items:
+        yield item
+    print(stats.summary())
 
-    #return results
 
+def _save_last_pulled_after(items, path, last_pulled):
+    """ Yield each item, then save last_pulled (see find_changed_repos). """
+    for item in items:
+        yield item
+    write_last_pulled(path, last_pulled)
 
-def write_grades(grades, out_path):
+
+def merge_profiles(students, profile_dir):
+    """ Combine the profiles of these students into one, saved as all.pstats in
+    profile_dir, and return its path. """
+    paths = [get_profile_path(profile_dir, s) for s in students]
+    paths = [p for p in paths if os.path.exists(p)]
+    if not paths:
+        return None
+    stats = pstats.Stats(*paths)
+    out_path = os.path.join(profile_dir, 'all.pstats')
+    stats.dump_stats(out_path)
+    print('saved profile of %d students in %s' % (len(paths), out_path))
+    return out_path
+
+
+def journal_header(students, test_path, extra_path=None):
+    """ Return the header of a grading journal, which identifies the test file,
+    roster and extra deductions that its grades are for. """
+    roster = json.dumps(students, sort_keys=True).encode('utf-8')
+    return {'test_hash': hash_file(test_path),
+            'roster_hash': hashlib.sha1(roster).hexdigest(),
+            'extra_hash': hash_file(extra_path) if extra_path else None}
+
+
+def start_journal(journal_path, header, resume=False):
+    """
+    Prepare the journal of a grading run, a file whose first line is its header
+    and whose other lines are the grades saved so far.
+    If resume is True and the journal has the same header, return a dictionary
+    from github_id to each grade already in it; a final line left incomplete by an
+    interrupted write is discarded. Otherwise start a new journal and return {}.
+    Return None if resuming a journal with a different header.
+    """
+    prior = {}
+    if resume and os.path.exists(journal_path):
+        with open(journal_path, 'rb') as f:
+            data = f.read()
+        lines = data.split(b'\n')[:-1]  # The last piece is empty or incomplete.
+        if not lines or json.loads(lines[0].decode('utf-8')) != header:
+            return None
+        length = len(lines[0]) + 1
+        for line in lines[1:]:
+            try:
+                grade = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            prior[grade['student']['github_id']] = grade
+            length += len(line) + 1
+        with open(journal_path, 'r+b') as f:
+            f.truncate(length)
+        print('resuming with %d grades from %s' % (len(prior), journal_path))
+    else:
+        with open(journal_path, 'wb') as f:
+            f.write((json.dumps(header) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+    return prior
+
+
+def append_journal(fd, grade):
+    """ Append a grade to the journal open as fd, with a single write, and sync it to disk. """
+    os.write(fd, (json.dumps(grade) + '\n').encode('utf-8'))
+    os.fsync(fd)
+
+
+def write_grades(grades, out_path, journal_path=None, prior=None, queue_size=16):
+    """
+    Write each grade as a line of JSON to out_path. If journal_path is given,
+    each grade not in prior (see start_journal) is also appended to the journal
+    before it is written, and the journal is removed once all grades are saved.
+    Grades are written by a separate thread, so grading may run up to queue_size
+    grades ahead of writing.
+    """
+    prior = prior or {}
+    journal = os.open(journal_path, os.O_WRONLY | os.O_APPEND) if journal_path else None
     outf = open(out_path, 'w')
-    for g in grades:
+    stats = QueueStats('write', queue_size)
+
+    def write(g):
+        if journal is not None and g['student']['github_id'] not in prior:
+            append_journal(journal, g)
         outf.write(json.dumps(g) + '\n')
         outf.flush()
-    outf.close()
+
+    try:
+        _write_behind(write, grades, queue_size, stats)
+    finally:
+        outf.close()
+        if journal is not None:
+            os.close(journal)
+    if journal is not None:
+        os.remove(journal_path)
+    print(stats.summary())
     print('saved results in %s' % out_path)
 
 
@@ -153,8 +1103,21 @@ def main():
     print('working directory=%s' % path)
     students = read_students(args['--students'])
     print('read %d students' % len(students))
-    results = run_tests(students, args['--test'], path, args['--pull'], student2extra)
-    write_grades(results, args['--output'])
+    journal_path = args['--output'] + '.journal'
+    if args['--profile'] and not os.path.isdir(args['--profile']):
+        os.makedirs(args['--profile'])
+    prior = start_journal(journal_path, journal_header(students, args['--test'], args['--extra']), args['--resume'])
+    if prior is None:
+        sys.exit('%s is for a different test file, roster or extra deductions; cannot resume.' % journal_path)
+    results = run_tests(students, args['--test'], path, args['--pull'], student2extra,
+                        jobs=int(args['--jobs']), cache_path=args['--cache'],
+                        preload=args['--preload'].split(',') if args['--preload'] else None,
+                        test_jobs=int(args['--test-jobs']), prior=prior, profile_dir=args['--profile'],
+                        ref=args['--ref'], before=args['--before'], pull_jobs=int(args['--pull-jobs']),
+                        queue_size=int(args['--queue-size']), check_jobs=int(args['--check-jobs']))
+    write_grades(results, args['--output'], journal_path, prior, int(args['--queue-size']))
+    if args['--profile']:
+        merge_profiles(students, args['--profile'])
 
 
 if __name__ == '__main__':
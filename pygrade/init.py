@@ -20,7 +20,7 @@ from github3 import login
 import os
 import time
 import traceback
-from . import clone_repo, get_local_repo, pull_repo, read_students
+from . import add_alternate, clone_repo, get_local_repo, pull_repo, read_students, update_reference_repo
 
 
 def lookup_team(existing_teams, name):
@@ -102,6 +102,8 @@ def create_repos_and_teams(students, org_name, github, path, remote_repo):
 
     existing_teams = [t for t in org.teams()]
     existing_repos = [r for r in org.repositories()]
+    # Student repos borrow the template's objects from one local copy, so each fetches only its own.
+    reference = update_reference_repo(remote_repo, path)
     for s in students:
         print('initializing repo %s for %s' % (s['github_repo'], s['github_id']))
         user = search_for_user(github, s['github_id'])
@@ -119,10 +121,12 @@ def create_repos_and_teams(students, org_name, github, path, remote_repo):
         local_repo = get_local_repo(s, path)
         if os.path.exists(local_repo):
             print('  found existing local repo at %s' % local_repo)
+            if reference:
+                add_alternate(local_repo, reference)
             pull_repo(local_repo)
         else:
             mkdir(local_repo)
-            clone_repo(s, path)
+            clone_repo(s, path, reference=reference)
         write_readme(s, local_repo)
         push_readme(local_repo)
         add_remote(local_repo, remote_repo)
@@ -2,32 +2,78 @@
 # -*- coding: utf-8 -*-
 """Summarize grades.
 
+Without --db, the reports are aggregated in one pass over the grades file, in
+memory that does not grow with the number of students. With --db, grades are
+imported into a SQLite database, with tables of runs (one per grades file
+imported), students, grades, deductions and tests, which the reports query, so
+grades imported once (with --grades) can be summarized again without reading
+them, by their run (the last one imported, unless --run is given).
+
 usage:
-    pygrade summarize [--grades <file>] [--test-names <names>] [--student-names <names>]
+    pygrade summarize [--grades <file>] [--db <file>] [--run <id>] [--test-names <names>] [--merge <x>]
+                      [--student-names <names>] [--timing] [--stats]
+    pygrade summarize --profile <file> [--top <n>] [--workdir <file>]
 
 Options
     -h, --help
-    -g, --grades <file>              JSON grades output by the grade command [default: grades.json]
-    -t, --test-names <names>         Comma-separated list of test names to summarize.
+    -m, --merge <x>                  Also merge error clusters of a test whose signatures are at least this similar
+                                     (0 to 1), e.g. 0.9.
+    -d, --db <file>                  SQLite database of grades to import into and summarize from.
+    -g, --grades <file>              JSON grades output by the grade command to import; grades.json if --db is not
+                                     given. Importing a file again replaces the run imported from it before.
+    -r, --run <id>                   Run in the database to summarize; see the runs table. Defaults to the last
+                                     one imported.
+    -p, --profile <file>             Print the hotspots of a profile saved by pygrade grade --profile.
+    -n, --top <n>                    Number of functions to print from the profile [default: 30]
+    -w, --workdir <file>             Directory of student repositories when the profile was taken [default: students]
+    -T, --timing                     Report the slowest tests and the slowest students.
+    -S, --stats                      Report grade percentiles and histogram, and the pass rate, discrimination
+                                     and most correlated failures of each test.
+    -t, --test-names <names>         Comma-separated list of test names to summarize. Their errors are clustered
+                                     by signature: the exception, the last frame and the message, with its
+                                     numbers, strings and addresses masked.
     -s, --student-names <names>      Comma-separated list of student github ids to summarize.
 """
+from array import array
 from collections import Counter, defaultdict
+from difflib import SequenceMatcher
 from docopt import docopt
+import heapq
 import json
+import numpy as np
+import os
+import pstats
 import re
+import sqlite3
+import sys
+import time
 
 
-def print_grade_distribution(grades):
-    print('\n\n----------------------------\ngrade distribution:\ngrade\tcount\tstudents')
-    counts = Counter(float(g['grade']) for g in grades)
-    grade2students = defaultdict(lambda: [])
-    for g in grades:
-        grade2students[g['grade']].append(g['student']['github_id'])
-    for grade, count in sorted(counts.items(), reverse=True):
-        if count < 10:
-            print('%d\t%d\t%s' % (grade, count, ' '.join(grade2students[grade])))
-        else:
-            print('%d\t%d' % (grade, count))
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT UNIQUE, assignment TEXT, imported TEXT);
+CREATE TABLE IF NOT EXISTS students (id INTEGER PRIMARY KEY, github_id TEXT UNIQUE, github_repo TEXT);
+CREATE TABLE IF NOT EXISTS grades (
+    id INTEGER PRIMARY KEY, run INTEGER, student INTEGER, grade REAL, possible_points REAL, time_graded TEXT,
+    import_time REAL, test_time REAL, git_commit TEXT, UNIQUE (run, student));
+CREATE TABLE IF NOT EXISTS deductions (
+    id INTEGER PRIMARY KEY, run INTEGER, student INTEGER, test TEXT, summary TEXT, points REAL, trace TEXT,
+    error TEXT, signature TEXT);
+CREATE INDEX IF NOT EXISTS deductions_test ON deductions (run, test, signature);
+CREATE INDEX IF NOT EXISTS deductions_student ON deductions (run, student);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY, run INTEGER, student INTEGER, name TEXT, status TEXT, wall_time REAL, cpu_time REAL,
+    memory REAL);
+CREATE INDEX IF NOT EXISTS tests_name ON tests (run, name);
+CREATE INDEX IF NOT EXISTS tests_student ON tests (run, student);
+"""
+
+
+def open_db(db_path=':memory:'):
+    """ Open, creating it if need be, the SQLite database of grades. """
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    return db
 
 
 def clean_summary(s):
@@ -37,63 +83,614 @@ def clean_summary(s):
         return s.strip()
 
 
-def print_test_distribution(grades):
+def trace_error(trace):
+    """ Return the part of a deduction's trace before the source of the test. """
+    return trace[:trace.index('source:')].strip() if 'source:' in trace else trace.strip()
+
+
+FRAME_RE = re.compile(r'^[ \t]*File "([^"]+)", line \d+(?:, in (\S+))?', re.M)
+COMMIT_SUFFIX_RE = re.compile(r'@[0-9a-f]+$')
+EXCEPTION_RE = re.compile(r'^([A-Za-z_][\w.]*)(?::[ \t]*(.*))?$', re.M)
+LITERAL_RES = [(re.compile(r'\b0x[0-9a-fA-F]+\b'), '<addr>'),
+               (re.compile(r'\'[^\']*\'|"[^"]*"'), '<str>'),
+               (re.compile(r'-?\b\d+(?:\.\d+)?\b'), '<num>')]
+
+
+def extract_error(trace):
+    """ Return the exception type and the first line of its message from a trace, or None.
+    >>> extract_error('Traceback (most recent call last):\\n  File "t.py", line 2, in f\\nValueError: bad x\\n')
+    ('ValueError', 'bad x')
+    """
+    error = trace_error(trace)
+    last_frame = None
+    for last_frame in FRAME_RE.finditer(error):
+        pass
+    match = EXCEPTION_RE.search(error, last_frame.end() if last_frame else 0)
+    if match:
+        return match.group(1), match.group(2) or ''
+    return None
+
+
+def mask_literals(message):
+    """
+    >>> mask_literals("[1, 2.5] != ['a'] at 0x7f3a")
+    '[<num>, <num>] != [<str>] at <addr>'
+    """
+    for literal_re, mask in LITERAL_RES:
+        message = literal_re.sub(mask, message)
+    return message
+
+
+def trace_signature(trace):
+    """ Reduce a trace to its exception, the function it was raised in and its
+    message with literals masked, so that traces differing only in values,
+    addresses or line numbers share a signature. The @<sha> that files graded
+    from a commit (see grade --ref) are named with is dropped too.
+    >>> trace_signature('  File "/s1/a0.py", line 2, in f\\n    raise ValueError(x)\\nValueError: 42\\n')
+    'ValueError: <num> [a0.py:f]'
+    >>> trace_signature('  File "/s2/a0.py", line 9, in f\\n    raise ValueError(x)\\nValueError: 7\\n')
+    'ValueError: <num> [a0.py:f]'
+    >>> trace_signature('  File "/s1/a0.py@4ae14de1ea0c", line 2, in f\\nValueError: dolphin\\n')
+    'ValueError: dolphin [a0.py:f]'
+    >>> trace_signature('  File "/s2/a0.py@5f45195ad3be", line 2, in f\\nValueError: dolphin\\n')
+    'ValueError: dolphin [a0.py:f]'
+    """
+    error = trace_error(trace)
+    last_frame = None
+    for last_frame in FRAME_RE.finditer(error):
+        pass
+    frame = ''
+    if last_frame:
+        filename = COMMIT_SUFFIX_RE.sub('', os.path.basename(last_frame.group(1)))
+        frame = ' [%s]' % ':'.join(filter(None, [filename, last_frame.group(2)]))
+    exception = extract_error(error)
+    if exception:
+        return '%s: %s%s' % (exception[0], mask_literals(exception[1]), frame)
+    return mask_literals(error.split('\n')[0]) + frame
+
+
+def merge_clusters(rows, threshold):
+    """ Merge each error cluster into the first larger one whose signature has
+    the same exception and is at least threshold similar.
+    >>> merge_clusters([('E: <num> [a.py:f]', 2, ['s1', 's2'], 'E: 1'), ('E: <num> [a.py:g]', 1, ['s3'], 'E: 2'),
+    ...                 ('F: x', 1, ['s4'], 'F: x')], 0.9)
+    [('E: <num> [a.py:f]', 3, ['s1', 's2', 's3'], 'E: 1'), ('F: x', 1, ['s4'], 'F: x')]
+    """
+    merged = []
+    for signature, count, students, error in rows:
+        exception = signature.split(':')[0]
+        for i, (signature2, count2, students2, error2) in enumerate(merged):
+            if signature2.split(':')[0] == exception and \
+               SequenceMatcher(None, signature, signature2).ratio() >= threshold:
+                merged[i] = (signature2, count2 + count, students2 + students, error2)
+                break
+        else:
+            merged.append((signature, count, students, error))
+    return sorted(merged, key=lambda x: -x[1])
+
+
+def get_student_id(db, student):
+    row = db.execute('SELECT id FROM students WHERE github_id = ?', (student['github_id'],)).fetchone()
+    if row:
+        db.execute('UPDATE students SET github_repo = ? WHERE id = ?', (student.get('github_repo'), row[0]))
+        return row[0]
+    return db.execute('INSERT INTO students (github_id, github_repo) VALUES (?, ?)',
+                      (student['github_id'], student.get('github_repo'))).lastrowid
+
+
+def import_grades(db, grades_path):
+    """ Import the grades in this file, one JSON object per line, as a new run,
+    replacing any run imported from the same file before, and return its id. """
+    source = os.path.abspath(grades_path)
+    old = db.execute('SELECT id FROM runs WHERE source = ?', (source,)).fetchone()
+    if old:
+        for table in ['grades', 'deductions', 'tests']:
+            db.execute('DELETE FROM %s WHERE run = ?' % table, (old[0],))
+        db.execute('DELETE FROM runs WHERE id = ?', (old[0],))
+    run = db.execute('INSERT INTO runs (source, imported) VALUES (?, ?)', (source, time.asctime())).lastrowid
+    assignment = None
+    with open(grades_path) as f:
+        for line in f:
+            g = json.loads(line)
+            assignment = assignment or ','.join(g.get('assignment') or [])
+            student = get_student_id(db, g['student'])
+            timing = g.get('timing')
+            # A student graded twice in one file (e.g. after resuming) keeps only their last grade.
+            for table in ['deductions', 'tests']:
+                db.execute('DELETE FROM %s WHERE run = ? AND student = ?' % table, (run, student))
+            db.execute('INSERT OR REPLACE INTO grades (run, student, grade, possible_points, time_graded, import_time, '
+                       'test_time, git_commit) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (run, student, g['grade'], g.get('possible_points'), g.get('time_graded'),
+                        timing['import'] if timing else None, timing.get('tests') if timing else None, g.get('commit')))
+            db.executemany('INSERT INTO deductions (run, student, test, summary, points, trace, error, signature) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(run, student, clean_summary(d['summary']), d['summary'], d['points'], d['trace'],
+                             trace_error(d['trace']), trace_signature(d['trace'])) for d in g['deductions']])
+            db.executemany('INSERT INTO tests (run, student, name, status, wall_time, cpu_time, memory) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(run, student, t['name'], t['status'], t['wall_time'], t['cpu_time'], t['memory'])
+                            for t in g.get('tests', [])])
+    db.execute('UPDATE runs SET assignment = ? WHERE id = ?', (assignment, run))
+    db.commit()
+    return run
+
+
+def last_run(db):
+    """ Return the id of the run imported last, or None if there are none. """
+    row = db.execute('SELECT MAX(id) FROM runs').fetchone()
+    return row[0]
+
+
+def split_names(names):
+    return sorted(set([s.strip() for s in names.split(',')])) if names else []
+
+
+def error_clusters(clusters):
+    """ Return (signature, count, students, representative error) rows, largest
+    first, from a dict of signature to (first error, students). """
+    return sorted([(signature, len(students), students, error)
+                   for signature, (error, students) in clusters.items()], key=lambda x: -x[1])
+
+
+class RunReports(object):
+    """ Reports on one run of the grades database, each a list of rows to print. """
+
+    def __init__(self, db, run):
+        self.db = db
+        self.run = run
+
+    def grade_distribution(self):
+        rows = []
+        for grade, count in self.db.execute('SELECT grade, COUNT(*) FROM grades WHERE run = ? GROUP BY grade '
+                                            'ORDER BY grade DESC', (self.run,)).fetchall():
+            students = None
+            if count < 10:
+                students = [s for s, in self.db.execute('SELECT github_id FROM grades JOIN students ON '
+                                                        'student = students.id WHERE run = ? AND grade = ? '
+                                                        'ORDER BY grades.id', (self.run, grade))]
+            rows.append((grade, count, students))
+        return rows
+
+    def test_distribution(self):
+        rows = []
+        for test, count in self.db.execute('SELECT test, COUNT(*) FROM deductions WHERE run = ? GROUP BY test '
+                                           'ORDER BY COUNT(*) DESC, MIN(id)', (self.run,)).fetchall():
+            students = None
+            if count < 10:
+                students = [s for s, in self.db.execute('SELECT github_id FROM deductions JOIN students ON '
+                                                        'student = students.id WHERE run = ? AND test = ? '
+                                                        'ORDER BY deductions.id', (self.run, test))]
+            rows.append((test, count, students))
+        return rows
+
+    def errors(self, test):
+        clusters = {}
+        for signature, error, student in self.db.execute('SELECT signature, error, github_id FROM deductions JOIN '
+                                                         'students ON student = students.id WHERE run = ? AND '
+                                                         'test = ? ORDER BY deductions.id', (self.run, test)):
+            clusters.setdefault(signature, (error, []))[1].append(student)
+        return error_clusters(clusters)
+
+    def student_deductions(self, student_names):
+        rows = self.db.execute('SELECT students.id, github_id FROM grades JOIN students ON student = students.id '
+                               'WHERE run = ? AND github_id IN (%s) ORDER BY grades.id'
+                               % ','.join('?' * len(student_names)), [self.run] + list(student_names)).fetchall()
+        return [(github_id, self.db.execute('SELECT points, test, trace FROM deductions WHERE run = ? AND '
+                                            'student = ? ORDER BY id', (self.run, student)).fetchall())
+                for student, github_id in rows]
+
+    def outcomes(self):
+        matrix = OutcomeMatrix()
+        rows = {}
+        for student, github_id, grade in self.db.execute('SELECT student, github_id, grade FROM grades JOIN '
+                                                         'students ON student = students.id WHERE run = ? '
+                                                         'ORDER BY grades.id', (self.run,)):
+            rows[student] = matrix.add_student(github_id, grade)
+        for student, tests in self.db.execute('SELECT student, GROUP_CONCAT(test, char(10)) FROM grades LEFT JOIN '
+                                              'deductions USING (run, student) WHERE run = ? AND student NOT IN '
+                                              '(SELECT student FROM tests WHERE run = ?) GROUP BY student',
+                                              (self.run, self.run)):
+            if ran_unrecorded(tests.split('\n') if tests else []):
+                matrix.add_unrecorded([rows[student]])
+        for query, record in [('SELECT student, name, status FROM tests WHERE run = ?', matrix.set_statuses),
+                              ('SELECT student, test, points FROM deductions WHERE run = ?', matrix.add_losses)]:
+            cells = self.db.execute(query, (self.run,)).fetchall()
+            if cells:
+                students, tests, values = zip(*cells)
+                record([rows[s] for s in students], tests, values)
+        return matrix
+
+    def slowest_tests(self, n=20):
+        return self.db.execute('SELECT name, COUNT(*), SUM(wall_time), MAX(wall_time), SUM(cpu_time), MAX(memory) '
+                               'FROM tests WHERE run = ? GROUP BY name ORDER BY SUM(wall_time) DESC LIMIT ?',
+                               (self.run, n)).fetchall()
+
+    def slowest_students(self, n=20):
+        return self.db.execute('SELECT github_id, import_time, COALESCE(test_time, 0) FROM grades JOIN students ON '
+                               'student = students.id WHERE run = ? AND import_time IS NOT NULL '
+                               'ORDER BY import_time + COALESCE(test_time, 0) DESC LIMIT ?',
+                               (self.run, n)).fetchall()
+
+
+class StreamReports(object):
+    """ The same reports as RunReports, aggregated in one pass over a grades file.
+    Memory is bounded by the number of distinct grades and tests, not by the
+    number of students: student lists are kept only while under 10 long, and
+    traces only for the tests and students asked for. With stats, the outcome
+    of each test is also kept, in a few bytes per student and test.
+    """
+
+    def __init__(self, test_names=(), student_names=(), n=20, stats=False):
+        self.matrix = OutcomeMatrix() if stats else None
+        self.test_names = set(test_names)
+        self.student_names = set(student_names)
+        self.n = n
+        self.grades = {}
+        self.tests = {}
+        self.clusters = defaultdict(dict)
+        self.deductions = []
+        self.times = {}
+        self.student_times = []
+        self.read = 0
+
+    def _count(self, counts, key, student):
+        count, students = counts.get(key, (0, []))
+        if students is not None:
+            students = students + [student] if count < 9 else None
+        counts[key] = (count + 1, students)
+
+    def add(self, grade):
+        student = grade['student']['github_id']
+        self._count(self.grades, float(grade['grade']), student)
+        for d in grade['deductions']:
+            test = clean_summary(d['summary'])
+            self._count(self.tests, test, student)
+            # Traces are only read for the tests asked for.
+            if test in self.test_names:
+                self.clusters[test].setdefault(trace_signature(d['trace']),
+                                               (trace_error(d['trace']), []))[1].append(student)
+        if student in self.student_names:
+            self.deductions.append((student, [(d['points'], clean_summary(d['summary']), d['trace'])
+                                              for d in grade['deductions']]))
+        for t in grade.get('tests', []):
+            count, total, longest, cpu, memory = self.times.get(t['name'], (0, 0., 0., 0., None))
+            if t['memory'] is not None:
+                memory = max(memory, t['memory']) if memory is not None else t['memory']
+            self.times[t['name']] = (count + 1, total + t['wall_time'], max(longest, t['wall_time']),
+                                     cpu + t['cpu_time'], memory)
+        timing = grade.get('timing')
+        if timing:
+            test_time = timing.get('tests', 0)
+            # Ties go to the student read first, as in a stable sort.
+            entry = (timing['import'] + test_time, -self.read, student, timing['import'], test_time)
+            if len(self.student_times) < self.n:
+                heapq.heappush(self.student_times, entry)
+            else:
+                heapq.heappushpop(self.student_times, entry)
+        if self.matrix is not None:
+            self.matrix.add(grade)
+        self.read += 1
+
+    def add_file(self, grades_path):
+        with open(grades_path) as f:
+            for line in f:
+                self.add(json.loads(line))
+        return self
+
+    def grade_distribution(self):
+        return [(grade, count, students) for grade, (count, students) in sorted(self.grades.items(), reverse=True)]
+
+    def outcomes(self):
+        return self.matrix
+
+    def test_distribution(self):
+        return sorted([(test, count, students) for test, (count, students) in self.tests.items()],
+                      key=lambda x: -x[1])
+
+    def errors(self, test):
+        return error_clusters(self.clusters[test])
+
+    def student_deductions(self, student_names):
+        return [(student, deductions) for student, deductions in self.deductions if student in student_names]
+
+    def slowest_tests(self, n=20):
+        return sorted([(test,) + times for test, times in self.times.items()], key=lambda x: -x[2])[:n]
+
+    def slowest_students(self, n=20):
+        return [(student, import_time, test_time)
+                for total, _, student, import_time, test_time in sorted(self.student_times, reverse=True)][:n]
+
+
+STATUS_CODES = {'pass': 0, 'fail': 1, 'error': 2, 'timeout': 3}
+
+# Deductions for a submission whose tests did not run at all (see grade.failed_result).
+RUN_FAILURE_RE = re.compile(r'(cannot import|no commit|grading) ')
+
+
+def ran_unrecorded(tests):
+    """ Return whether a student's tests ran though none of them were recorded, as
+    in grades files from before test records, given the tests of their deductions.
+    >>> ran_unrecorded(['test_a', 'test_b'])
+    True
+    >>> ran_unrecorded(['cannot import asg0/asg0.py'])
+    False
+    """
+    return not any(RUN_FAILURE_RE.match(test) for test in tests)
+
+
+class OutcomeMatrix(object):
+    """ The outcome of every test for every student, collected one student at a
+    time into flat arrays, and returned as NumPy matrices by matrices():
+    status, with the index of each test's status in STATUS_CODES (-1 if it did
+    not run), and lost, the points it cost. Tests are named as in the test
+    failures distribution, so the clean_summary of a deduction. A student whose
+    tests ran without being recorded (see add_unrecorded) passed every test
+    without a deduction.
+    """
+
+    def __init__(self):
+        self.students = []
+        self.grades = array('d')
+        self.tests = {}
+        self.status_cells = (array('l'), array('l'), array('b'))
+        self.loss_cells = (array('l'), array('l'), array('d'))
+        self.unrecorded = array('l')
+
+    def add_student(self, github_id, grade):
+        self.students.append(github_id)
+        self.grades.append(grade)
+        return len(self.students) - 1
+
+    def _column(self, test):
+        return self.tests.setdefault(test, len(self.tests))
+
+    def _columns(self, tests):
+        try:
+            return list(map(self.tests.__getitem__, tests))
+        except KeyError:
+            return [self._column(test) for test in tests]
+
+    def set_statuses(self, rows, tests, statuses):
+        """ Record the status of each test in tests for the student in the same place in rows. """
+        self.status_cells[0].extend(rows)
+        self.status_cells[1].extend(self._columns(tests))
+        self.status_cells[2].extend([STATUS_CODES.get(status, -1) for status in statuses])
+
+    def add_losses(self, rows, tests, points):
+        self.loss_cells[0].extend(rows)
+        self.loss_cells[1].extend(self._columns(tests))
+        self.loss_cells[2].extend(points)
+
+    def add_unrecorded(self, rows):
+        """ Record that the tests of the students in rows ran, but only their deductions were recorded. """
+        self.unrecorded.extend(rows)
+
+    def add(self, grade):
+        row = self.add_student(grade['student']['github_id'], grade['grade'])
+        tests = grade.get('tests', [])
+        self.set_statuses([row] * len(tests), [t['name'] for t in tests], [t['status'] for t in tests])
+        lost = [clean_summary(d['summary']) for d in grade['deductions']]
+        self.add_losses([row] * len(lost), lost, [d['points'] for d in grade['deductions']])
+        if 'tests' not in grade and ran_unrecorded(lost):
+            self.add_unrecorded([row])
+
+    def matrices(self):
+        """ Return the test names, by column, the grades, and the status and lost matrices. """
+        shape = (len(self.students), len(self.tests))
+        status = np.full(shape, -1, dtype=np.int8)
+        lost = np.zeros(shape, dtype=np.float32)
+        tested = [col for test, col in self.tests.items() if not RUN_FAILURE_RE.match(test)]
+        status[np.ix_(np.frombuffer(self.unrecorded, dtype=self.unrecorded.typecode), tested)] = STATUS_CODES['pass']
+        rows, cols, points = [np.frombuffer(a, dtype=a.typecode) for a in self.loss_cells]
+        # A deduction without a test record (e.g. from an import error) counts as a failure.
+        status[rows, cols] = STATUS_CODES['fail']
+        np.add.at(lost, (rows, cols), points)
+        rows, cols, codes = [np.frombuffer(a, dtype=a.typecode) for a in self.status_cells]
+        status[rows, cols] = codes
+        tests = sorted(self.tests, key=self.tests.get)
+        return tests, np.frombuffer(self.grades, dtype=np.float64), status, lost
+
+
+def pass_rates(status):
+    """ Return the number of students who ran each test, and the fraction of them who passed it.
+    >>> pass_rates(np.array([[0, 1], [0, -1], [2, 0]]))
+    (array([3, 2]), array([0.66666667, 0.5       ]))
+    """
+    ran = (status >= 0).sum(axis=0)
+    return ran, (status == 0).sum(axis=0) / np.maximum(ran, 1)
+
+
+def column_correlations(x, y):
+    """ Return the Pearson correlation of each column of x with the same column of y,
+    or nan where either is constant. """
+    x = x - x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (x * y).sum(axis=0) / np.sqrt((x * x).sum(axis=0) * (y * y).sum(axis=0))
+
+
+def discrimination(status, lost, grades):
+    """ Return the item discrimination of each test: the correlation between
+    passing it and the grade the student would have had without its deduction,
+    so that the test's own points do not inflate it. Tests that strong students
+    pass and weak students fail score near 1.
+    >>> status = np.array([[0, 0, 0], [0, 1, 0], [1, 0, 1], [1, 1, 1]])
+    >>> lost = 5. * (status == 1)
+    >>> discrimination(status, lost, 15 - lost.sum(axis=1)).round(2)
+    array([0.71, 0.  , 0.71])
+    """
+    return column_correlations((status == 0).astype(np.float64), grades[:, None] + lost)
+
+
+def failure_correlations(tests, status, n=10):
+    """ Return the n pairs of tests whose failures (or errors) are most correlated across students. """
+    failed = (status > 0).astype(np.float64)
+    failed -= failed.mean(axis=0)
+    norms = np.sqrt((failed * failed).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = (failed.T @ failed) / np.outer(norms, norms)
+    rows, cols = np.triu_indices(len(tests), 1)
+    values = correlations[rows, cols]
+    order = [i for i in np.argsort(-values, kind='stable')[:n] if values[i] > 0]
+    return [(tests[rows[i]], tests[cols[i]], values[i]) for i in order]
+
+
+def print_stats(matrix, percentiles=(10, 25, 50, 75, 90), bins=10):
+    tests, grades, status, lost = matrix.matrices()
+    if not len(grades):
+        return
+    print('\n\n----------------------------\ngrade statistics:\nmean\tstd\t%s' %
+          '\t'.join('p%d' % p for p in percentiles))
+    print('%.2f\t%.2f\t%s' % (grades.mean(), grades.std(),
+                              '\t'.join('%.2f' % p for p in np.percentile(grades, percentiles))))
+    print('\n\n----------------------------\ngrade histogram:\n%13s\tcount' % 'grades')
+    counts, edges = np.histogram(grades, bins=bins)
+    for count, low, high in zip(counts, edges, edges[1:]):
+        print('%6.2f-%6.2f\t%d' % (low, high, count))
+    ran, rates = pass_rates(status)
+    lost_mean = lost.sum(axis=0) / np.maximum(ran, 1)
+    discriminations = discrimination(status, lost, grades)
+    print('\n\n----------------------------\ntest statistics:\n%20s\tran\tpassed\tlost\tdiscrimination' % 'test')
+    for j in np.lexsort((np.array(tests, dtype=object), rates)):
+        print('%20s\t%d\t%.3f\t%.2f\t%.3f' % (tests[j], ran[j], rates[j], lost_mean[j], discriminations[j]))
+    print('\n\n----------------------------\nmost correlated test failures:\n%20s\t%20s\tcorrelation' %
+          ('test', 'test'))
+    for test1, test2, correlation in failure_correlations(tests, status):
+        print('%20s\t%20s\t%.3f' % (test1, test2, correlation))
+
+
+def print_grade_distribution(rows):
+    print('\n\n----------------------------\ngrade distribution:\ngrade\tcount\tstudents')
+    for grade, count, students in rows:
+        if students is not None:
+            print('%d\t%d\t%s' % (grade, count, ' '.join(students)))
+        else:
+            print('%d\t%d' % (grade, count))
+
+
+def print_test_distribution(rows):
     print('\n\n----------------------------\ntest failures distribution:\n%20s\tcount\tstudents' % 'test')
-    counts = Counter()
-    test2students = defaultdict(lambda: [])
-    for g in grades:
-        counts.update(clean_summary(d['summary']) for d in g['deductions'])
-        for d in g['deductions']:
-            test2students[clean_summary(d['summary'])].append(g['student']['github_id'])
-
-    for test, count in sorted(counts.items(), key=lambda x: x[1], reverse=True):
-        if count < 10:
-            print('%20s\t%d\t%s' % (test, count, ' '.join(test2students[test])))
+    for test, count, students in rows:
+        if students is not None:
+            print('%20s\t%d\t%s' % (test, count, ' '.join(students)))
         else:
             print('%20s\t%d' % (test, count))
 
-def extract_error(trace):
-    re.find('.*([A-Za-z]Error:.+)$', trace)
-
-def summarize_errors(grades, test_names):
-    test_names = set([s.strip() for s in test_names.split(',')])
-    test2error_counts = defaultdict(lambda: Counter())
-    error2students = defaultdict(lambda: [])
-    for g in grades:
-        for d in g['deductions']:
-            test_name = clean_summary(d['summary'])
-            if test_name in test_names:
-                trace = d['trace']
-                text = trace[:trace.index('source:')].strip() if 'source:' in trace else trace.strip()
-                test2error_counts[test_name].update([text])
-                error2students[test_name + '__' + text].append(g['student']['github_id'])
-    for test, error_counts in sorted(test2error_counts.items()):
+
+def summarize_errors(reports, test_names, merge=None):
+    for test in test_names:
+        rows = reports.errors(test)
+        if not rows:
+            continue
+        if merge is not None:
+            rows = merge_clusters(rows, merge)
         print('\n\n----------------------------\nSummary of errors for test %s\n' % test)
-        for error, count in sorted(error_counts.items(), key=lambda x: -x[1]):
+        for signature, count, students, error in rows:
             print('count=%d' % count)
-            print('students=%s' % ' '.join(error2students[test + '__' + error]))
+            print('students=%s' % ' '.join(students))
+            print('signature=%s' % signature)
             print(error)
             print('\n')
 
 
-def summarize_students(grades, student_names):
-    student_names = set([s.strip() for s in student_names.split(',')])
-    for g in grades:
-        if g['student']['github_id'] in student_names:
-            print('\n\n----------------------------\nSummary of errors for student %s\n' % g['student']['github_id'])
-            for d in g['deductions']:
-                print('\n%d points deducted for %s' % (d['points'], clean_summary(d['summary'])))
-                print(d['trace'])
+def summarize_students(reports, student_names):
+    for student, deductions in reports.student_deductions(student_names):
+        print('\n\n----------------------------\nSummary of errors for student %s\n' % student)
+        for points, test, trace in deductions:
+            print('\n%d points deducted for %s' % (points, test))
+            print(trace)
+
+
+def print_slowest_tests(rows):
+    """ Print the tests that took the most time in total, across all students. """
+    print('\n\n----------------------------\nslowest tests:\n%20s\tcount\ttotal\tmean\tmax\tcpu\tmemory' % 'test')
+    for test, count, total, longest, cpu, memory in rows:
+        print('%20s\t%d\t%.2f\t%.3f\t%.3f\t%.2f\t%s' % (test, count, total, total / count, longest, cpu,
+                                                        '%dK' % memory if memory is not None else '-'))
+
+
+def print_slowest_students(rows):
+    """ Print the students whose assignments took the most time to import and test. """
+    print('\n\n----------------------------\nslowest students:\n%20s\ttotal\timport\ttests' % 'student')
+    for student, import_time, test_time in rows:
+        print('%20s\t%.2f\t%.2f\t%.2f' % (student, import_time + test_time, import_time, test_time))
+
+
+def print_reports(reports, test_names, student_names, timing, merge=None, stats=False):
+    print_grade_distribution(reports.grade_distribution())
+    print_test_distribution(reports.test_distribution())
+    if test_names:
+        summarize_errors(reports, test_names, merge)
+    if student_names:
+        summarize_students(reports, student_names)
+    if timing:
+        print_slowest_tests(reports.slowest_tests())
+        print_slowest_students(reports.slowest_students())
+    if stats:
+        print_stats(reports.outcomes())
+
+
+def profile_category(filename, workdir):
+    """ Classify the file a profiled function is in as student code, pygrade, tests
+    (any other file named test*.py), or library code.
+    >>> profile_category('/tmp/students/repo1/a0/a0.py', '/tmp/students')
+    'student code'
+    >>> profile_category('/usr/lib/python3/json/decoder.py', '/tmp/students')
+    'libraries'
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.abspath(filename)
+    if path.startswith(os.path.abspath(workdir) + os.sep):
+        return 'student code'
+    elif path.startswith(package_dir + os.sep):
+        return 'pygrade'
+    elif os.path.basename(path).startswith('test') and path.endswith('.py'):
+        return 'tests'
+    return 'libraries'
+
+
+def print_profile(profile_path, n, workdir):
+    """ Print how time in this profile divides between student code, tests, pygrade
+    and libraries, and the n functions with the most cumulative time. """
+    stats = pstats.Stats(profile_path)
+    category_times = Counter()
+    for (filename, line, function), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+        category_times[profile_category(filename, workdir)] += tottime
+    print('\n\n----------------------------\ntime by code:\n%20s\tseconds\tpercent' % 'code')
+    total = sum(category_times.values()) or 1
+    for category, seconds in category_times.most_common():
+        print('%20s\t%.2f\t%.1f' % (category, seconds, 100. * seconds / total))
+    print('\n\n----------------------------\ntop %d functions by cumulative time:' % n)
+    stats.sort_stats('cumulative').print_stats(n)
+
 
 def main():
     args = docopt(__doc__)
-    grades = [json.loads(s) for s in open(args['--grades'])]
-    print_grade_distribution(grades)
-    print_test_distribution(grades)
-    if args['--test-names']:
-        summarize_errors(grades, args['--test-names'])
-    if args['--student-names']:
-        summarize_students(grades, args['--student-names'])
+    if args['--profile']:
+        print_profile(args['--profile'], int(args['--top']), args['--workdir'])
+        return
+    test_names = split_names(args['--test-names'])
+    student_names = split_names(args['--student-names'])
+    if not args['--db']:
+        reports = StreamReports(test_names, student_names, stats=args['--stats']).add_file(
+            args['--grades'] or 'grades.json')
+    else:
+        db = open_db(args['--db'])
+        if args['--grades']:
+            run = import_grades(db, args['--grades'])
+            print('imported %s into %s as run %d' % (args['--grades'], args['--db'], run))
+        elif args['--run']:
+            run = int(args['--run'])
+            if not db.execute('SELECT 1 FROM runs WHERE id = ?', (run,)).fetchone():
+                sys.exit('no run %d in %s; see its runs table' % (run, args['--db']))
+        else:
+            run = last_run(db)
+            if run is None:
+                sys.exit('no runs in %s; import one with --grades' % args['--db'])
+        reports = RunReports(db, run)
+    print_reports(reports, test_names, student_names, args['--timing'],
+                  float(args['--merge']) if args['--merge'] else None, args['--stats'])
+
 
 if __name__ == '__main__':
     main()
@@ -8,9 +8,97 @@ test_pygrade
 Tests for `pygrade` module.
 """
 
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
+import git
+
 from pygrade import pygrade
+from pygrade import add_alternate, cheat, clone_repos, grade, read_blobs, read_last_pulled, summarize, \
+    update_reference_repo
+
+
+TEST_FILE = """
+'''
+@name=asg0/asg0.py
+@possible_points=20
+'''
+import unittest
+from asg0 import *
+
+
+class TestAssignment(unittest.TestCase):
+    def test_simple(self):
+        ''' @points=5 '''
+        self.assertTrue(is_mammal('cat'))
+
+    def test_hard(self):
+        ''' @points=5 '''
+        self.assertTrue(is_mammal('dolphin'))
+
+    def test_add(self):
+        ''' @points=10 '''
+        self.assertEqual(add(2, 2), 4)
+"""
+
+SUBMISSIONS = [
+    "def is_mammal(x):\n    return x in ('cat', 'dolphin')\n\ndef add(a, b):\n    return a + b\n",
+    "def is_mammal(x):\n    return x == 'cat'\n\ndef add(a, b):\n    return 0\n",
+    "def is_mammal(x):\n    raise ValueError(x)\n\ndef add(a, b):\n    return a + b\n",
+    "def is_mammal(x)\n    return True\n",
+]
+
+
+def make_cohort(path):
+    """ Write a test file and one submission per entry of SUBMISSIONS under path. """
+    test_path = os.path.join(path, 'test_asg0.py')
+    with open(test_path, 'w') as f:
+        f.write(TEST_FILE)
+    students = []
+    for i, src in enumerate(SUBMISSIONS):
+        s = {'github_repo': 'https://github.com/x/student%d' % i, 'github_id': 'student%d' % i}
+        asg_dir = os.path.join(grade.get_local_repo(s, path), 'asg0')
+        os.makedirs(asg_dir)
+        with open(os.path.join(asg_dir, 'asg0.py'), 'w') as f:
+            f.write(src)
+        students.append(s)
+    return students, test_path
+
+
+def make_remote(path, name, src):
+    """ Create a bare remote repository under path with one commit of src as
+    asg0/asg0.py, and return its student and a working clone to push more from. """
+    remote = git.Repo.init(os.path.join(path, 'remotes', name + '.git'), bare=True)
+    work = git.Repo.clone_from(remote.git_dir, os.path.join(path, 'work', name))
+    os.makedirs(os.path.join(work.working_dir, 'asg0'))
+    push_submission(work, src)
+    return {'github_repo': remote.git_dir[:-len('.git')], 'github_id': name}, work
+
+
+def push_submission(work, src):
+    """ Commit src as asg0/asg0.py in this working clone and push it. """
+    with open(os.path.join(work.working_dir, 'asg0', 'asg0.py'), 'w') as f:
+        f.write(src)
+    work.index.add(['asg0/asg0.py'])
+    work.index.commit('asg0')
+    work.remotes.origin.push('HEAD:refs/heads/master')
+    return work.head.commit.hexsha
+
+
+def strip_times(results):
+    """ Remove the fields of each result that vary from run to run. """
+    for r in results:
+        r.pop('time_graded')
+        r.pop('timing', None)
+        for t in r.get('tests', []):
+            for key in ['wall_time', 'cpu_time', 'memory']:
+                t.pop(key)
+    return results
 
 
 class TestPygrade(unittest.TestCase):
@@ -25,6 +113,413 @@ class TestPygrade(unittest.TestCase):
         pass
 
 
+class TestGrade(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.students, self.test_path = make_cohort(self.path)
+        self.extra = grade.read_extra_deductions({'--extra': None})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_serial(self):
+        results = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra))
+        self.assertEqual([r['grade'] for r in results], [20, 5, 10, 0])
+        self.assertEqual([[t['status'] for t in r.get('tests', [])] for r in results],
+                         [['pass'] * 3, ['fail', 'fail', 'pass'], ['pass', 'error', 'error'], []])
+
+    def test_parallel_matches_serial(self):
+        serial = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra))
+        parallel = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra, jobs=3))
+        self.assertEqual(strip_times(serial), strip_times(parallel))
+
+    def test_test_jobs_match_serial(self):
+        serial = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra))
+        split = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra, test_jobs=3))
+        self.assertEqual(strip_times(serial), strip_times(split))
+
+    def test_fork_server_matches_serial(self):
+        serial = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra))
+        forked = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra,
+                                      jobs=2, preload=['json']))
+        self.assertEqual(strip_times(serial), strip_times(forked))
+
+    def test_cache(self):
+        cache_path = os.path.join(self.path, 'cache.json')
+        first = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra,
+                                     cache_path=cache_path))
+        with open(os.path.join(grade.get_local_repo(self.students[1], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write(SUBMISSIONS[0])
+        second = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra,
+                                      cache_path=cache_path))
+        self.assertEqual([r['grade'] for r in second], [20, 20, 10, 0])
+        self.assertEqual([first[i] for i in (0, 2, 3)], [second[i] for i in (0, 2, 3)])
+        self.assertEqual(len(grade.read_cache(cache_path)), 4)
+
+    def test_cache_skips_killed(self):
+        cache_path = os.path.join(self.path, 'cache.json')
+        with open(os.path.join(grade.get_local_repo(self.students[1], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write('while True:\n    pass\n')
+        with open(os.path.join(grade.get_local_repo(self.students[2], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write(SUBMISSIONS[0].replace("return x in", "while x == 'dolphin':\n        pass\n    return x in"))
+        with open(self.test_path, 'w') as f:
+            f.write(TEST_FILE.replace('@possible_points=20', '@possible_points=20\n@student_timeout=2')
+                    .replace("@points=5 '''\n        self.assertTrue(is_mammal('dolphin'))",
+                             "@points=5 @timeout=0.2 '''\n        self.assertTrue(is_mammal('dolphin'))"))
+        results = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra,
+                                       cache_path=cache_path))
+        self.assertIn('time limit', results[1]['deductions'][0]['summary'])
+        self.assertEqual([t['status'] for t in results[2]['tests']], ['pass', 'timeout', 'pass'])
+        self.assertEqual(sorted(grade.read_cache(cache_path)), ['student0', 'student3'])
+
+    def test_resume(self):
+        out_path = os.path.join(self.path, 'grades.json')
+        journal_path = out_path + '.journal'
+        header = grade.journal_header(self.students, self.test_path)
+
+        def interrupted():
+            for i, result in enumerate(grade.run_tests(self.students, self.test_path, self.path, False, self.extra)):
+                if i == 2:
+                    raise KeyboardInterrupt()
+                yield result
+
+        grade.start_journal(journal_path, header)
+        self.assertRaises(KeyboardInterrupt, grade.write_grades, interrupted(), out_path, journal_path, {})
+        with open(journal_path, 'ab') as f:
+            f.write(b'{"student": {"github_id": ')
+        self.assertIsNone(grade.start_journal(journal_path, dict(header, test_hash=None), resume=True))
+        prior = grade.start_journal(journal_path, header, resume=True)
+        self.assertEqual(sorted(prior), ['student0', 'student1'])
+        results = grade.run_tests(self.students, self.test_path, self.path, False, self.extra, prior=prior)
+        grade.write_grades(results, out_path, journal_path, prior)
+        self.assertFalse(os.path.exists(journal_path))
+        with open(out_path) as f:
+            resumed = [json.loads(line) for line in f]
+        full = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra))
+        self.assertEqual(strip_times(resumed), strip_times(full))
+
+    def test_time_limits(self):
+        with open(os.path.join(grade.get_local_repo(self.students[1], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write('def is_mammal(x):\n    while True:\n        pass\n\ndef add(a, b):\n    return a + b\n')
+        with open(os.path.join(grade.get_local_repo(self.students[2], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write('while True:\n    pass\n')
+        with open(self.test_path, 'w') as f:
+            f.write(TEST_FILE.replace('@possible_points=20',
+                                      '@possible_points=20\n@test_timeout=0.2\n@student_timeout=2'))
+        results = list(grade.run_tests(self.students[:3], self.test_path, self.path, False, self.extra))
+        self.assertEqual([r['grade'] for r in results], [20, 10, 0])
+        self.assertIn('TimeLimitExceeded', results[1]['deductions'][0]['trace'])
+        self.assertIn('time limit', results[2]['deductions'][0]['summary'])
+
+    @unittest.skipIf(grade.reset_peak_rss() is None, 'peak memory cannot be reset here')
+    def test_memory_is_per_test_peak(self):
+        with open(os.path.join(grade.get_local_repo(self.students[0], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write(SUBMISSIONS[0].replace('    return x in', '    bytearray(64 * 1024 * 1024)\n    return x in'))
+        results = list(grade.run_tests(self.students[:1], self.test_path, self.path, False, self.extra))
+        memory = dict((t['name'], t['memory']) for t in results[0]['tests'])
+        self.assertGreater(memory['test_hard'], 32 * 1024)
+        self.assertGreater(memory['test_simple'], 32 * 1024)
+        self.assertLess(memory['test_add'], 32 * 1024)
+
+    def test_ref(self):
+        for s in self.students:
+            repo = git.Repo.init(grade.get_local_repo(s, self.path))
+            repo.index.add(['asg0/asg0.py'])
+            repo.index.commit('asg0')
+            with open(os.path.join(repo.working_dir, 'asg0', 'asg0.py'), 'w') as f:
+                f.write('not python\n')
+        results = list(grade.run_tests(self.students, self.test_path, self.path, False, self.extra, ref='HEAD'))
+        self.assertEqual([r['grade'] for r in results], [20, 5, 10, 0])
+        self.assertEqual(len(results[0]['commit']), 40)
+        results = list(grade.run_tests(self.students[:1], self.test_path, self.path, False, self.extra,
+                                       before='2000-01-01'))
+        self.assertEqual(results[0]['grade'], 0)
+
+    def test_pull_before_grades_fetched_commit(self):
+        s, work = make_remote(self.path, 'remote0', SUBMISSIONS[1])
+        workdir = os.path.join(self.path, 'students')
+        git.Repo.clone_from(s['github_repo'], grade.get_local_repo(s, workdir))
+        sha = push_submission(work, SUBMISSIONS[0])
+        results = list(grade.run_tests([s], self.test_path, workdir, True, self.extra, before='2099-12-31'))
+        self.assertEqual((results[0]['grade'], results[0]['commit']), (20, sha))
+
+
+class TestClone(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_clone_repos(self):
+        remote = git.Repo.init(os.path.join(self.path, 'remotes', 'student0.git'), bare=True)
+        students = [{'github_repo': remote.working_dir[:-len('.git')], 'github_id': 'student0'},
+                    {'github_repo': os.path.join(self.path, 'remotes', 'missing'), 'github_id': 'student1'}]
+        workdir = os.path.join(self.path, 'students')
+        report = clone_repos(students, workdir, jobs=2, retries=2, backoff=0)
+        self.assertEqual(report['cloned'], [students[0]['github_repo']])
+        self.assertEqual([f['attempts'] for f in report['failed']], [1])
+        report = clone_repos(students, workdir, jobs=2)
+        self.assertEqual(report['skipped'], [students[0]['github_repo']])
+        self.assertEqual(len(report['failed']), 1)
+
+    def test_clone_with_reference(self):
+        template, work = make_remote(self.path, 'template', SUBMISSIONS[0])
+        remote = git.Repo.init(os.path.join(self.path, 'remotes', 'student0.git'), bare=True)
+        work.git.push(remote.git_dir, 'HEAD:refs/heads/master')
+        students = [{'github_repo': 'file://' + remote.git_dir[:-len('.git')], 'github_id': 'student0'}]
+        workdir = os.path.join(self.path, 'students')
+        reference = update_reference_repo('file://' + template['github_repo'] + '.git', workdir)
+        self.assertTrue(git.Repo(reference).bare)
+        self.assertEqual(update_reference_repo('file://' + template['github_repo'] + '.git', workdir), reference)
+        report = clone_repos(students, workdir, reference=reference)
+        self.assertEqual(report['cloned'], [students[0]['github_repo']])
+        # The student's history is the template's, so the clone stores no objects of its own.
+        counts = git.Repo(grade.get_local_repo(students[0], workdir)).git.count_objects('-v')
+        self.assertIn('in-pack: 0', counts.splitlines())
+        alternates = os.path.join(grade.get_local_repo(students[0], workdir), '.git', 'objects', 'info',
+                                  'alternates')
+        with open(alternates) as f:
+            self.assertEqual(f.read().splitlines(), [os.path.join(reference, 'objects')])
+        # Cloning again, or adding the alternate to an existing clone, adds it only once.
+        report = clone_repos(students, workdir, reference=reference)
+        self.assertEqual(report['skipped'], [students[0]['github_repo']])
+        add_alternate(grade.get_local_repo(students[0], workdir), reference)
+        with open(alternates) as f:
+            self.assertEqual(f.read().splitlines(), [os.path.join(reference, 'objects')])
+        # A clone made without a reference gets the alternate added once.
+        os.remove(alternates)
+        for i in range(2):
+            add_alternate(grade.get_local_repo(students[0], workdir), reference)
+        with open(alternates) as f:
+            self.assertEqual(f.read().splitlines(), [os.path.join(reference, 'objects')])
+        self.assertEqual(git.Repo(grade.get_local_repo(students[0], workdir)).git.fsck(), '')
+
+    def test_sparse_clone(self):
+        students = []
+        for name in ['student0', 'student1']:
+            s, work = make_remote(self.path, name, SUBMISSIONS[1])
+            os.makedirs(os.path.join(work.working_dir, 'asg1'))
+            with open(os.path.join(work.working_dir, 'asg1', 'asg1.py'), 'w') as f:
+                f.write(SUBMISSIONS[0])
+            work.index.add(['asg1/asg1.py'])
+            work.index.commit('asg1')
+            work.remotes.origin.push('HEAD:refs/heads/master')
+            # Partial clones need the server to allow filters, as GitHub does.
+            git.Repo(s['github_repo'] + '.git').git.config('uploadpack.allowFilter', 'true')
+            students.append({'github_repo': 'file://' + s['github_repo'], 'github_id': name})
+        workdir = os.path.join(self.path, 'students')
+        report = clone_repos(students, workdir, sparse=['asg0'])
+        self.assertEqual(report['cloned'], [s['github_repo'] for s in students])
+        repos = [grade.get_local_repo(s, workdir) for s in students]
+        self.assertTrue(os.path.exists(os.path.join(repos[0], 'asg0', 'asg0.py')))
+        self.assertFalse(os.path.exists(os.path.join(repos[0], 'asg1')))
+        # Files outside the checkout are not fetched until read.
+        missing = git.Repo(repos[0]).git.rev_list('--objects', '--missing=print', 'HEAD').splitlines()
+        self.assertEqual(len([line for line in missing if line.startswith('?')]), 1)
+        self.assertEqual(read_blobs(repos[0], 'HEAD', ['asg1/asg1.py']), {'asg1/asg1.py': SUBMISSIONS[0].encode()})
+        # Cloning again for another assignment adds its directory to the checkout.
+        report = clone_repos(students[:1], workdir, sparse=['asg0', 'asg1'])
+        self.assertEqual(report['skipped'], [students[0]['github_repo']])
+        self.assertTrue(os.path.exists(os.path.join(repos[0], 'asg1', 'asg1.py')))
+        # So does grading it.
+        test_path = os.path.join(self.path, 'test_asg1.py')
+        with open(test_path, 'w') as f:
+            f.write(TEST_FILE.replace('asg0', 'asg1'))
+        results = list(grade.run_tests(students[1:], test_path, workdir, False,
+                                       grade.read_extra_deductions({'--extra': None})))
+        self.assertEqual(results[0]['grade'], 20)
+        self.assertTrue(os.path.exists(os.path.join(repos[1], 'asg1', 'asg1.py')))
+
+    def test_pull_skips_unchanged(self):
+        test_path = make_cohort(self.path)[1]
+        extra = grade.read_extra_deductions({'--extra': None})
+        s, work = make_remote(self.path, 'remote0', SUBMISSIONS[1])
+        workdir = os.path.join(self.path, 'students')
+        git.Repo.clone_from(s['github_repo'], grade.get_local_repo(s, workdir))
+
+        def pull(**kwargs):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                results = list(grade.run_tests([s], test_path, workdir, True, extra, **kwargs))
+            action = [line.split()[0] for line in out.getvalue().splitlines()
+                      if line.startswith(('pulling', 'fetching', 'unchanged'))]
+            return action + [results[0]['grade']]
+
+        self.assertEqual(pull(), ['pulling', 5])
+        self.assertEqual(pull(), ['unchanged', 5])
+        sha = push_submission(work, SUBMISSIONS[0])
+        # Fetching for --ref does not update the working tree, so the next plain pull still pulls.
+        self.assertEqual(pull(ref='origin/master'), ['fetching', 20])
+        self.assertEqual(pull(ref='origin/master'), ['unchanged', 20])
+        self.assertEqual(pull(), ['pulling', 20])
+        self.assertEqual(pull(), ['unchanged', 20])
+        self.assertEqual(read_last_pulled(workdir), {'pull': {'remote0': sha}, 'fetch': {'remote0': sha}})
+        # A pull that fails (here, over a local change) is not recorded, so it is tried again.
+        push_submission(work, SUBMISSIONS[2])
+        with open(os.path.join(grade.get_local_repo(s, workdir), 'asg0', 'asg0.py'), 'w') as f:
+            f.write(SUBMISSIONS[1])
+        self.assertEqual(pull(), ['pulling', 5])
+        self.assertEqual(read_last_pulled(workdir)['pull'], {'remote0': sha})
+        self.assertEqual(pull()[0], 'pulling')
+
+
+class TestCheat(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.students, self.test_path = make_cohort(self.path)
+        copy = {'github_repo': 'https://github.com/x/copy', 'github_id': 'copy'}
+        os.makedirs(os.path.join(grade.get_local_repo(copy, self.path), 'asg0'))
+        with open(os.path.join(grade.get_local_repo(copy, self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write('# my own work\n' + SUBMISSIONS[0])
+        self.students.append(copy)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_minhash_finds_copy(self):
+        results = cheat.compare_assignments(self.students, self.test_path, self.path, 'minhash', 0.8)
+        self.assertEqual([(d, os.path.basename(f1), os.path.basename(f2)) for d, f1, f2 in results],
+                         [(0, 'student0', 'copy')])
+        tfidf = cheat.compare_assignments(self.students, self.test_path, self.path)
+        self.assertEqual(len(tfidf), 10)
+        self.assertEqual(set(map(os.path.basename, tfidf[0][1:])), set(['student0', 'copy']))
+
+    def test_parallel_cache_matches_serial(self):
+        serial = cheat.compare_assignments(self.students, self.test_path, self.path)
+        cache_dir = os.path.join(self.path, 'cache')
+        parallel = cheat.compare_assignments(self.students, self.test_path, self.path, jobs=2, cache_dir=cache_dir)
+        self.assertEqual(parallel, serial)
+        cached = {name: os.stat(os.path.join(cache_dir, name)).st_ino for name in os.listdir(cache_dir)}
+        self.assertEqual(len(cached), 5)
+        # A second run reads every file from the cache rather than writing it again.
+        self.assertEqual(cheat.compare_assignments(self.students, self.test_path, self.path, jobs=2,
+                                                   cache_dir=cache_dir), serial)
+        self.assertEqual({name: os.stat(os.path.join(cache_dir, name)).st_ino for name in os.listdir(cache_dir)},
+                         cached)
+
+    def test_winnow_finds_renamed_copy(self):
+        with open(os.path.join(grade.get_local_repo(self.students[-1], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write('""" Mine. """\n\n\n' + SUBMISSIONS[0].replace('x', 'animal').replace("'cat'", "'dog'"))
+        results = cheat.compare_assignments(self.students, self.test_path, self.path, 'winnow', 0.9)
+        self.assertEqual([(d, os.path.basename(f1), os.path.basename(f2)) for d, f1, f2, regions in results],
+                         [(0, 'student0', 'copy')])
+        self.assertEqual(results[0][3], 'asg0/asg0.py:1-5=asg0/asg0.py:4-8')
+
+    def test_winnow_finds_three_way_copy(self):
+        copy = {'github_repo': 'https://github.com/x/copy2', 'github_id': 'copy2'}
+        os.makedirs(os.path.join(grade.get_local_repo(copy, self.path), 'asg0'))
+        with open(os.path.join(grade.get_local_repo(copy, self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write(SUBMISSIONS[0])
+        results = cheat.compare_assignments(self.students + [copy], self.test_path, self.path, 'winnow', 0.9)
+        self.assertEqual(sorted(tuple(sorted([os.path.basename(f1), os.path.basename(f2)]))
+                                for d, f1, f2, regions in results),
+                         [('copy', 'copy2'), ('copy', 'student0'), ('copy2', 'student0')])
+
+    def test_archive_matches_winnow(self):
+        archive_path = os.path.join(self.path, 'archive.db')
+        winnow = cheat.compare_assignments(self.students, self.test_path, self.path, 'winnow', 0.9)
+        archived = cheat.compare_assignments(self.students, self.test_path, self.path, 'winnow', 0.9,
+                                             archive_path=archive_path)
+        self.assertEqual(archived, winnow)
+        # Later runs find the pair with only the copier in students, and after the copy is removed, nothing.
+        self.assertEqual(cheat.compare_assignments(self.students[-1:], self.test_path, self.path, 'winnow', 0.9,
+                                                   archive_path=archive_path), winnow)
+        with open(os.path.join(grade.get_local_repo(self.students[-1], self.path), 'asg0', 'asg0.py'), 'w') as f:
+            f.write('x = 1\n')
+        self.assertEqual(cheat.compare_assignments(self.students, self.test_path, self.path, 'winnow', 0.9,
+                                                   archive_path=archive_path), [])
+
+    def test_archive_lower_threshold(self):
+        archive_path = os.path.join(self.path, 'archive.db')
+        cheat.compare_assignments(self.students, self.test_path, self.path, 'winnow', 0.9, archive_path=archive_path)
+        winnow = cheat.compare_assignments(self.students, self.test_path, self.path, 'winnow', 0.1)
+        self.assertGreater(len(winnow), 1)
+        self.assertEqual(cheat.compare_assignments(self.students, self.test_path, self.path, 'winnow', 0.1,
+                                                   archive_path=archive_path), winnow)
+
+    def test_top_k_matches_all_pairs(self):
+        all_pairs = cheat.compare_assignments(self.students, self.test_path, self.path)
+        nearest = cheat.compare_assignments(self.students, self.test_path, self.path, top_k=1)
+        self.assertLessEqual(len(nearest), len(self.students))
+        self.assertEqual(nearest[0][1:], all_pairs[0][1:])
+        self.assertAlmostEqual(nearest[0][0], all_pairs[0][0])
+        similar = cheat.compare_assignments(self.students, self.test_path, self.path, threshold=0.9)
+        self.assertEqual([pair[1:] for pair in similar], [all_pairs[0][1:]])
+
+
+class TestSummarize(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        students, test_path = make_cohort(self.path)
+        extra = grade.read_extra_deductions({'--extra': None})
+        self.grades_path = os.path.join(self.path, 'grades.json')
+        grade.write_grades(grade.run_tests(students, test_path, self.path, False, extra), self.grades_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_import_grades(self):
+        db = summarize.open_db(os.path.join(self.path, 'grades.db'))
+        run = summarize.import_grades(db, self.grades_path)
+        self.assertEqual(summarize.import_grades(db, self.grades_path), run + 1)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM runs').fetchone()[0], 1)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM students').fetchone()[0], 4)
+        self.assertEqual(db.execute('SELECT test, COUNT(*) FROM deductions GROUP BY test ORDER BY test').fetchall(),
+                         [('cannot import asg0/asg0.py', 1), ('test_add', 1), ('test_hard', 2), ('test_simple', 1)])
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM tests WHERE status = ?', ('pass',)).fetchone()[0], 5)
+
+    def test_stream_matches_db(self):
+        db = summarize.open_db()
+        reports = summarize.RunReports(db, summarize.import_grades(db, self.grades_path))
+        names = ['test_hard', 'cannot import asg0/asg0.py']
+        stream = summarize.StreamReports(names, ['student1', 'student3']).add_file(self.grades_path)
+        self.assertEqual(stream.grade_distribution(), reports.grade_distribution())
+        self.assertEqual(stream.test_distribution(), reports.test_distribution())
+        self.assertEqual([stream.errors(test) for test in names], [reports.errors(test) for test in names])
+        self.assertEqual(stream.student_deductions(['student1', 'student3']),
+                         [(s, [tuple(d) for d in ds])
+                          for s, ds in reports.student_deductions(['student1', 'student3'])])
+        self.assertEqual(sorted(stream.slowest_students()), sorted(reports.slowest_students()))
+
+    def test_outcome_matrix(self):
+        matrix = summarize.StreamReports(stats=True).add_file(self.grades_path).outcomes()
+        tests, grades, status, lost = matrix.matrices()
+        self.assertEqual(tests, ['test_add', 'test_hard', 'test_simple', 'cannot import asg0/asg0.py'])
+        self.assertEqual(grades.tolist(), [20, 5, 10, 0])
+        self.assertEqual(status.tolist(), [[0, 0, 0, -1], [1, 1, 0, -1], [0, 2, 2, -1], [-1, -1, -1, 1]])
+        self.assertEqual(lost.sum(axis=1).tolist(), [0, 15, 10, 20])
+        ran, rates = summarize.pass_rates(status)
+        self.assertEqual(ran.tolist(), [3, 3, 3, 1])
+        db = summarize.open_db()
+        tests2, grades2, status2, lost2 = summarize.RunReports(db, summarize.import_grades(db, self.grades_path)) \
+            .outcomes().matrices()
+        self.assertEqual((tests2, status2.tolist()), (tests, status.tolist()))
+
+    def test_outcome_matrix_legacy(self):
+        # Grades files from before test records have only the deductions.
+        legacy_path = os.path.join(self.path, 'legacy.json')
+        with open(self.grades_path) as f, open(legacy_path, 'w') as out:
+            for line in f:
+                g = json.loads(line)
+                g.pop('tests', None)
+                g.pop('timing', None)
+                out.write(json.dumps(g) + '\n')
+        tests, grades, status, lost = summarize.StreamReports(stats=True).add_file(legacy_path).outcomes().matrices()
+        self.assertEqual(tests, ['test_add', 'test_hard', 'test_simple', 'cannot import asg0/asg0.py'])
+        self.assertEqual(status.tolist(), [[0, 0, 0, -1], [1, 1, 0, -1], [0, 1, 1, -1], [-1, -1, -1, 1]])
+        ran, rates = summarize.pass_rates(status)
+        self.assertEqual(ran.tolist(), [3, 3, 3, 1])
+        db = summarize.open_db()
+        tests2, grades2, status2, lost2 = summarize.RunReports(db, summarize.import_grades(db, legacy_path)) \
+            .outcomes().matrices()
+        self.assertEqual(status2.tolist(), status.tolist())
+
+
 if __name__ == '__main__':
     import sys
     sys.exit(unittest.main())